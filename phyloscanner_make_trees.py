@@ -33,11 +33,12 @@ trying to be as concise as possible here.'''
 ################################################################################
 # The names of some files we'll create.
 FileForAlignedRefs = 'RefsAln.fasta'
+FileForRunManifest = 'RunManifest.json'
 
 # Some temporary working files we'll create
 TempFileForRefs = 'temp_refs.fasta'
-TempFileForPairwiseUnalignedRefs = 'temp_2Refs.fasta'
-TempFileForPairwiseAlignedRefs = 'temp_2RefsAln.fasta'
+TempFileForPairwiseUnalignedRefs_basename = 'temp_2Refs'
+TempFileForPairwiseAlignedRefs_basename = 'temp_2RefsAln'
 TempFileForReads_basename = 'temp_UnalignedReads'
 TempFileForOtherRefs_basename = 'temp_OtherRefs'
 TempFileForAllBootstrappedTrees_basename = 'temp_AllBootstrappedTrees'
@@ -52,8 +53,15 @@ import re
 import copy
 import shutil
 import glob
+import json
+import hashlib
 import time
+import traceback
+import multiprocessing
+from multiprocessing.dummy import Pool as ThreadPool
+import threading
 import argparse
+import cStringIO
 import pysam
 from Bio import SeqIO
 from Bio import Seq
@@ -239,14 +247,75 @@ help='Used to specify the number of bootstraps to be calculated for RAxML trees'
 OtherArgs.add_argument('-Ns', '--bootstrap-seed', type=int, default=1, help='''
 Used to specify the random-number seed for running RAxML with bootstraps. The
 default is 1.''')
+OtherArgs.add_argument('--parallel-bootstraps', type=int, default=1,
+help='''The maximum number of bootstrap trees to be made with RAxML at the same
+time in each window (default: 1, i.e. one after another). Each bootstrap is run
+in its own working directory, so that the files made by different bootstraps
+cannot collide. Relevant only with --num-bootstraps.''')
 OtherArgs.add_argument('-OD', '--output-dir', help='''Used to specify the name
 of a directory into which output files will be moved.''')
+OtherArgs.add_argument('--processes', type=int, default=1, help='''The
+number of windows to process at the same time, each in its own process (default:
+1, i.e. one window after another). Each window is processed independently of the
+others, so with several processors available this can substantially reduce the
+total run time. Note that mafft and RAxML are run once per window, so also
+consider how many threads you ask each of those to use (with --x-mafft and
+--x-raxml). With --pairwise-align-to, this many pairwise alignments of
+references are also run at the same time, before processing any windows. What
+is printed for each window is printed in window order regardless. Cannot be
+used with --forbid-read-repeats or
+--inspect-disagreeing-overlaps, which need all windows to be processed in the
+same process.''')
+OtherArgs.add_argument('--external-jobs', type=int, help='''With this option,
+windows are processed by a scheduler that keeps up to the specified number of
+external programs (mafft and RAxML, including each RAxML bootstrap) running at
+the same time, drawn from all windows. While the external programs for some
+windows run, the reads in the next window are read and pre-processed, so that
+processors are not left idle waiting for one window's programs to finish. Set
+this to the number of processors you want to use (taking into account any
+threads you ask mafft and RAxML to use, with --x-mafft and --x-raxml). Bootstrap
+replicates in one window can then run at the same time as each other, up to
+this number (or up to --parallel-bootstraps if that is greater). With
+--pairwise-align-to, this many pairwise alignments of references are also run at
+the same time, before processing any windows. What is
+printed for each window is printed in window order regardless. Cannot be used
+with --processes.''')
+OtherArgs.add_argument('--read-bams-once', action='store_true', help='''By
+default, for each window we separately fetch from each bam file the reads
+overlapping that window, so that with overlapping windows each read is read from
+the bam file many times. With this option, instead we pass through each bam file
+just once before processing any windows, giving each read to every window it
+overlaps. This is faster when windows overlap substantially, but the reads found
+for all windows are held in memory together. Cannot be used with
+--forbid-read-repeats.''')
 OtherArgs.add_argument('--time', action='store_true',
 help='Print the times taken by different steps.')
 OtherArgs.add_argument('--x-mafft', default='mafft', help=''''Used to specify
 the command required to run mafft (by default: mafft). Whitespace is interpreted
 as separating mafft options, so if a path to the mafft binary is specified it
 may not contain whitespace. See also --x-mafft2.''')
+OtherArgs.add_argument('--mafft-cache', help='''Used to specify a directory
+(created if needed) in which to keep a copy of each alignment of reads made by
+mafft, for reuse: if the same reads (and external references, if any) are
+aligned with the same mafft options in any later run using the same directory,
+mafft is not run again. This is useful if you rerun with different RAxML options
+or more bootstraps, or resume after a crash. The pairwise alignments of
+references made with --pairwise-align-to are kept too, so that a reference
+already aligned to the same chosen reference in an earlier run is not aligned
+again. See also --mafft-cache-size.''')
+OtherArgs.add_argument('--mafft-cache-size', type=float, default=1000,
+help='''The maximum total size, in megabytes, of the alignments kept in the
+directory specified with --mafft-cache (default: 1000). When it is exceeded, the
+alignments used least recently are deleted.''')
+OtherArgs.add_argument('--stream-to-mafft', action='store_true', help='''With
+this option, the reads in each window are passed to mafft through a pipe, and
+the alignment mafft produces is read from a pipe, instead of each being written
+to a file and read back in. This saves time if the working directory is on a
+slow (e.g. network) file system. The aligned reads are still written to a file
+if they are part of the output; the temporary file of unaligned reads is not
+made. (With --alignment-of-other-refs, the unaligned reads are still written to
+a file, since mafft reads the sequences it adds to an existing alignment only
+from a file; only the alignment is then read from a pipe.)''')
 OtherArgs.add_argument('--x-mafft2', help='''"If you are using
 --pairwise-align-to, by default we will use a different command for pairwise
 alignment of references from what you specified with --x-mafft. Specifically, we
@@ -264,6 +333,20 @@ output. With this option, all output files will be in the same directory (either
 the working directory, or whatever you specify with --output-dir).''')
 OtherArgs.add_argument('-KT', '--keep-temp-files', action='store_true', help='''
 Keep temporary files we create on the way (these are deleted by default).''')
+OtherArgs.add_argument('--resume', action='store_true', help='''While it runs,
+phyloscanner records in the file ''' + FileForRunManifest + ''' (in the working
+directory) what each window produced in each stage of processing it (reading the
+reads, aligning them, excising positions, analysing the alignment, and making
+trees), together with a fingerprint of the input files and of the options used.
+If a run stops before finishing, rerun it from the same working directory with
+the same options plus this one, and windows whose output files are still present
+and unchanged will not be processed again. If only options relating to trees
+(--x-raxml, --num-bootstraps, --bootstrap-seed, --no-trees) have changed, only
+the trees are remade for such windows; any other change, or missing or changed
+output files, means the window is processed again from scratch. The manifest is
+deleted when a run finishes (unless --keep-temp-files is used). Cannot be used
+with --forbid-read-repeats or --inspect-disagreeing-overlaps, for which each
+window depends on the processing of previous windows.''')
 
 BioinformaticsArgs = parser.add_argument_group('Options for detailed'
 ' bioinformatic interrogation of the input bam files (not intended for normal'
@@ -388,9 +471,10 @@ RecombNormToDiv = args.recombination_norm_diversity
 # Print how this script was called, for logging purposes.
 print('phyloscanner was called thus:\n' + ' '.join(sys.argv))
 
-# Warn if RAxML files exist already.
-if not (args.no_trees or ExploreWindowWidths or ExploreWindowWidthsFast) and \
-glob.glob('RAxML*'):
+# Warn if RAxML files exist already. (If we're resuming, any left by the earlier
+# run for a window are removed before making trees for that window.)
+if not (args.no_trees or ExploreWindowWidths or ExploreWindowWidthsFast or \
+args.resume) and glob.glob('RAxML*'):
   print('Warning: RAxML files are present in the working directory. If their',
   'names clash with those that phyloscanner will try to create, RAxML will',
   'fail to run. Continuing.', file=sys.stderr)
@@ -512,6 +596,54 @@ if args.read_names_2 and MergeReadsB:
   'Quitting''', file=sys.stderr)
   exit(1)
 
+# --read-bams-once can't be used with --forbid-read-repeats, which needs the
+# reads in one window to be known before those in the next are collected.
+if args.read_bams_once and args.forbid_read_repeats:
+  print('The --read-bams-once option cannot be used with',
+  '--forbid-read-repeats. Quitting.', file=sys.stderr)
+  exit(1)
+
+# Sanity checks on processing windows in parallel.
+if args.processes < 1:
+  print('The --processes option requires a positive integer. Quitting.',
+  file=sys.stderr)
+  exit(1)
+if args.processes > 1 and (args.forbid_read_repeats or \
+args.inspect_disagreeing_overlaps):
+  print('The --processes option cannot be used with --forbid-read-repeats or',
+  '--inspect-disagreeing-overlaps. Quitting.', file=sys.stderr)
+  exit(1)
+
+# mafft reads the sequences given to --add only from a file, so with external
+# refs the reads in each window can't be streamed to it.
+StreamReadsToMafft = args.stream_to_mafft and not IncludeOtherRefs
+if args.stream_to_mafft and IncludeOtherRefs:
+  print('Warning: with --alignment-of-other-refs, --stream-to-mafft still',
+  'writes the unaligned reads in each window to a file; only the alignment is',
+  'read from a pipe.', file=sys.stderr)
+
+# --resume skips windows, which doesn't work if what is done in one window
+# depends on what was done in previous windows.
+if args.resume and (args.forbid_read_repeats or \
+args.inspect_disagreeing_overlaps):
+  print('The --resume option cannot be used with --forbid-read-repeats or',
+  '--inspect-disagreeing-overlaps. Quitting.', file=sys.stderr)
+  exit(1)
+
+if args.external_jobs != None:
+  if args.external_jobs < 1:
+    print('The --external-jobs option requires a positive integer. Quitting.',
+    file=sys.stderr)
+    exit(1)
+  if args.processes > 1:
+    print('The --external-jobs and --processes options cannot be used',
+    'together. Quitting.', file=sys.stderr)
+    exit(1)
+if args.parallel_bootstraps < 1:
+  print('The --parallel-bootstraps option requires a positive integer.',
+  'Quitting.', file=sys.stderr)
+  exit(1)
+
 # Sanity checks on using the pairwise alignment option.
 if PairwiseAlign:
   if args.ref_for_coords != None:
@@ -723,9 +855,7 @@ if ExcisePositions:
 
 PythonPath = sys.executable
 
-TranslateCoordsCode = pf.FindAndCheckCode(PythonPath, 'TranslateCoords.py')
-FindSeqsInFastaCode = pf.FindAndCheckCode(PythonPath, 'FindSeqsInFasta.py')
-FindWindowsCode     = pf.FindAndCheckCode(PythonPath,
+FindWindowsCode = pf.FindAndCheckCode(PythonPath,
 'FindInformativeWindowsInFasta.py')
 
 
@@ -747,6 +877,21 @@ if args.x_mafft2 == None:
 else:
   Mafft2ArgList = args.x_mafft2.split()
 
+# Set up the cache of mafft alignments, if desired.
+MafftCache = None
+if args.mafft_cache != None:
+  if args.mafft_cache_size <= 0:
+    print('The --mafft-cache-size option requires a positive number.',
+    'Quitting.', file=sys.stderr)
+    exit(1)
+  try:
+    MafftCache = pf.AlignmentCache(args.mafft_cache,
+    args.mafft_cache_size * 1048576)
+  except OSError as err:
+    print('Problem creating the directory', args.mafft_cache, 'for the',
+    '--mafft-cache option:', err, '\nQuitting.', file=sys.stderr)
+    exit(1)
+
 times = []
 if args.time:
   times.append(time.time())
@@ -772,56 +917,32 @@ for i,RefFile in enumerate(RefFiles):
   SeqList[0].id = BamAliases[i]
   RefSeqs += SeqList
 
-def TranslateCoords(CodeArgs):
-  '''Runs TranslateCoordsCode with the supplied args, and returns the results as
-  a dict.'''
+def TranslateCoords(AlignmentFile, coords, ChosenRef=None):
+  '''Translates coords with respect to ChosenRef in AlignmentFile (or with
+  respect to the alignment, if ChosenRef is None) to coords with respect to
+  every sequence in the alignment, returning the results as a dict.'''
 
+  SeqDict = collections.OrderedDict()
+  for seq in SeqIO.parse(open(AlignmentFile), 'fasta'):
+    if seq.id in SeqDict:
+      print('Two (or more) sequences in', AlignmentFile, 'are called', seq.id +\
+      '. Sequence names should be unique. Quitting.', file=sys.stderr)
+      exit(1)
+    SeqDict[seq.id] = str(seq.seq)
   try:
-    CoordsString = subprocess.check_output([PythonPath, TranslateCoordsCode] + \
-    CodeArgs)
-  except:
-    print('Problem executing', TranslateCoordsCode +'. Quitting.',
-    file=sys.stderr)
-    raise
-
-  CoordsDict = {}
-  for line in CoordsString.splitlines():
-
-    # Trim leading & trailing whitespace and skip blank lines
-    line = line.strip()
-    if line == '':
-      continue
+    CoordsDict = pf.TranslateCoords(SeqDict, coords, ChosenRef)
+  except ValueError as err:
+    print('Problem translating coordinates in ', AlignmentFile, ': ', err,
+    '\nQuitting.', sep='', file=sys.stderr)
+    exit(1)
 
-    # Each line in the output of the TranslateCoordsCode should be a sequence 
-    # name then the coordinates.
-    fields = line.split()
-    if len(fields) != NumCoords +1:
-      print('Unexpected number of fields in line\n' +line +'\nin the output '+\
-      'of ' +TranslateCoordsCode+'\nQuitting.', file=sys.stderr)
-      exit(1)
-    SeqName = fields[0]
-    coords = fields[1:]
-
-    # Convert the coordinates to integers.
-    # Where an alignment coordinate is inside a deletion in a particular
-    # sequence, TranslateCoords.py returns an integer + 0.5 for the coordinate 
-    # with respect to that sequence. Python won't convert such figures directly 
-    # from string to int, but we can do so via a float intermediate. This rounds 
-    # down, i.e. to the coordinate of the base immediately to the left of the
-    # deletion.
-    for i in range(len(coords)):
-      if coords[i] != 'NaN':
-        try:
-          coords[i] = int(coords[i])
-        except ValueError:
-          if '.5' in coords[i]:
-            coords[i] = int(float(coords[i]))
-          else:
-            print('Unable to understand the coordinate', coords[i],
-            'as an integer in line\n' +line +'\nin the output of '+\
-            TranslateCoordsCode+'\nQuitting.', file=sys.stderr)
-            exit(1)
-    CoordsDict[SeqName] = coords
+  # Where an alignment coordinate is inside a deletion in a particular
+  # sequence, the translated coordinate is an integer + 0.5. We round this
+  # down, i.e. to the coordinate of the base immediately to the left of the
+  # deletion.
+  for SeqName, CoordsInThisSeq in CoordsDict.items():
+    CoordsDict[SeqName] = [coord if coord == 'NaN' else int(coord) for coord \
+    in CoordsInThisSeq]
   return CoordsDict
 
 def SimpleCoordsFromAutoParams(RefSeqLength):
@@ -892,32 +1013,62 @@ else:
     ExternalRefWindowCoords = \
     pf.TranslateSeqCoordsToAlnCoords(RefForPairwiseAlnsGappySeq, WindowCoords)
 
-    CoordsInRefs = {}
-    for BamRefSeq in RefSeqs:
-
-      # Align
-      SeqIO.write([RefForPairwiseAlns,BamRefSeq], TempFileForPairwiseUnalignedRefs,
+    def AlignRefPairwise(RefNumber):
+      '''Aligns the RefNumber'th mapping reference to the chosen ref, in its
+      own temporary files so that different refs can be aligned at the same
+      time, and returns the name of the file containing the alignment.'''
+      RefSuffix = '_' + str(RefNumber + 1) + '.fasta'
+      UnalignedFile = TempFileForPairwiseUnalignedRefs_basename + RefSuffix
+      AlignedFile = TempFileForPairwiseAlignedRefs_basename + RefSuffix
+      SeqIO.write([RefForPairwiseAlns, RefSeqs[RefNumber]], UnalignedFile,
       "fasta")
-      TempFiles.add(TempFileForPairwiseUnalignedRefs)
-      with open(TempFileForPairwiseAlignedRefs, 'w') as f:
+      TempFiles.add(UnalignedFile)
+      TempFiles.add(AlignedFile)
+      Mafft2Options = Mafft2ArgList + ['--quiet', '--preservecase']
+      if MafftCache != None:
+        MafftCacheKey = MafftCache.Key(Mafft2Options, [UnalignedFile])
+        if MafftCache.Fetch(MafftCacheKey, AlignedFile):
+          return AlignedFile
+      with open(AlignedFile, 'w') as f:
         try:
-          ExitStatus = subprocess.call(Mafft2ArgList + ['--quiet',
-          '--preservecase', TempFileForPairwiseUnalignedRefs], stdout=f)
+          ExitStatus = subprocess.call(Mafft2Options + [UnalignedFile],
+          stdout=f)
           assert ExitStatus == 0
         except:
           print('Problem calling mafft. Quitting.', file=sys.stderr)
           raise
-      TempFiles.add(TempFileForPairwiseAlignedRefs)
+      if MafftCache != None:
+        MafftCache.Store(MafftCacheKey, AlignedFile)
+      return AlignedFile
+
+    # Align each mapping reference to the chosen ref, running as many
+    # alignments at the same time as we are allowed external programs.
+    if args.external_jobs != None:
+      NumPairwiseAlignJobs = args.external_jobs
+    else:
+      NumPairwiseAlignJobs = args.processes
+    NumPairwiseAlignJobs = min(NumPairwiseAlignJobs, len(RefSeqs))
+    if NumPairwiseAlignJobs > 1:
+      pool = ThreadPool(NumPairwiseAlignJobs)
+      PairwiseAlignmentFiles = pool.map(AlignRefPairwise, range(len(RefSeqs)))
+      pool.close()
+      pool.join()
+    else:
+      PairwiseAlignmentFiles = map(AlignRefPairwise, range(len(RefSeqs)))
+
+    CoordsInRefs = {}
+    for BamRefSeq, PairwiseAlignmentFile in zip(RefSeqs,
+    PairwiseAlignmentFiles):
 
       # Translate.
       # The index names in the PairwiseCoordsDict, labelling the coords found by
       # coord translation, should coincide with the two seqs we're considering.
-      PairwiseCoordsDict = TranslateCoords([TempFileForPairwiseAlignedRefs,
-      args.pairwise_align_to] + [str(coord) for coord in WindowCoords])
+      PairwiseCoordsDict = TranslateCoords(PairwiseAlignmentFile,
+      WindowCoords, args.pairwise_align_to)
       if set(PairwiseCoordsDict.keys()) != \
       set([BamRefSeq.id,args.pairwise_align_to]):
         print('Malfunction of phyloscanner: mismatch between the sequences',
-        'found in the output of', TranslateCoordsCode, 'and the two names "' + \
+        'found by coordinate translation and the two names "' + \
         BamRefSeq.id+'", "'+args.pairwise_align_to +'". Quitting.',
         file=sys.stderr)
         exit(1)
@@ -1004,24 +1155,54 @@ else:
       UserCoords = WindowCoords
 
     # Translate alignment coordinates to reference coordinates
-    CoordsInRefs = TranslateCoords([FileForAlignedRefs, '-A']+\
-    [str(coord) for coord in WindowCoords])
+    CoordsInRefs = TranslateCoords(FileForAlignedRefs, WindowCoords)
 
     # The index names in the CoordsInSeqs dicts, labelling the coords found by
     # coord translation, should cooincide with all seqs we're considering (i.e.
     # those in FileForAlignedRefs).
     if set(CoordsInRefs.keys()) != set(BamAliases+ExternalRefNames):
       print('Malfunction of phyloscanner: mismatch between the sequences found',
-      'in the output of', TranslateCoordsCode, 'and those in',
+      'by coordinate translation and those in',
       FileForAlignedRefs +'. Quitting.', file=sys.stderr)
       exit(1)
 
+    # Read the aligned external refs once, so that each window can take its
+    # slice of them in-process.
+    if IncludeOtherRefs:
+      AlignedExternalRefs = Align.MultipleSeqAlignment([seq for seq in
+      SeqIO.parse(open(FileForAlignedRefs), 'fasta')
+      if not seq.id in BamAliases])
+      AlignedExternalRefsMatrix = pf.AlignmentAsMatrix(AlignedExternalRefs)
+
 # Make index files for the bam files if needed.
 pf.MakeBamIndices(BamFiles, args.x_samtools)
 
 # Gather some data from each bam file
 BamFileRefSeqNames = {}
 BamFileRefLengths  = {}
+
+# Each bam file is opened once (loading its index once) and the handle reused
+# for all windows. Handles are keyed by process ID as well as file name, so that
+# a worker process does not use a handle inherited from its parent (which shares
+# the parent's file position), but opens its own.
+OpenBamFiles = {}
+
+def GetBamFile(BamFileName):
+  '''Returns an open pysam.AlignmentFile for the named bam file, opening it only
+  if this process has not already done so.'''
+  key = (os.getpid(), BamFileName)
+  if not key in OpenBamFiles:
+    OpenBamFiles[key] = pysam.AlignmentFile(BamFileName, "rb")
+  return OpenBamFiles[key]
+
+def CloseBamFiles():
+  '''Closes the bam files opened by this process with GetBamFile.'''
+  ThisProcess = os.getpid()
+  for key in OpenBamFiles.keys():
+    if key[0] == ThisProcess:
+      OpenBamFiles[key].close()
+      del OpenBamFiles[key]
+
 if args.verbose:
   print('Now preparing the bam files for analysis.')
 for i,BamFileName in enumerate(BamFiles):
@@ -1032,7 +1213,7 @@ for i,BamFileName in enumerate(BamFiles):
   # Prep for pysam. The call to the AlignmentFile function sometimes gives a
   # very unclear error depending on the pysam version: handle this defensively.
   try:
-    BamFile = pysam.AlignmentFile(BamFileName, "rb")
+    BamFile = GetBamFile(BamFileName)
   except AttributeError:
     test = getattr(pysam, 'AlignmentFile', None)
     if test != None:
@@ -1196,16 +1377,10 @@ CorrespondenceDict_TipNameToRawSeqs_AllSamples=None):
 
 def RemovePureGapCols(alignment):
   "Removes pure-gap columns from an alignment."
-  AlignmentLength = alignment.get_alignment_length()
-  for column in reversed(xrange(AlignmentLength)):
-    PureGap = True
-    for base in alignment[:, column]:
-      if base != GapChar:
-        PureGap = False
-        break
-    if PureGap:
-      alignment = alignment[:, :column] + alignment[:, column+1:]
-  return alignment
+  PureGapCols = (pf.AlignmentAsMatrix(alignment) == ord(GapChar)).all(axis=0)
+  if not PureGapCols.any():
+    return alignment
+  return pf.AlignmentWithColumns(alignment, ~PureGapCols)
 
 def ReMergeAlignedReads(alignment,
 CorrespondenceDict_TipNameToRawSeqs_AllSamples=None, ForceNoMerging=False):
@@ -1294,29 +1469,9 @@ def FindPatientsConsensuses(alignment):
   AlignmentLength = alignment.get_alignment_length()
   for SampleName, ReadsAndCounts in SampleReadCounts.items():
 
-    # Count each base seen at each position
-    BaseCounterDicts = [{} for pos in range(0,AlignmentLength)]
-    TotalCount = 0
-    for read, count in ReadsAndCounts.items():
-      TotalCount += count
-      for pos, base in enumerate(read):
-        if base in BaseCounterDicts[pos]:
-          BaseCounterDicts[pos][base] += count
-        else:
-          BaseCounterDicts[pos][base] = count
-
     # Find the most common 'base' (could be a gap) at each position.
-    consensus = ''
-    for pos, BaseCounterDict in enumerate(BaseCounterDicts):
-      MostCommonBase = None
-      HighestCount = 0
-      for base, count in BaseCounterDict.items():
-        if count > HighestCount:
-          MostCommonBase = base
-          HighestCount = count
-      assert MostCommonBase != None, 'Problem for ' + SampleName + \
-      ' at position ' + str(pos)
-      consensus += MostCommonBase
+    TotalCount = sum(ReadsAndCounts.values())
+    consensus = pf.ConsensusOfReads(ReadsAndCounts, AlignmentLength)
     SeqObject = SeqIO.SeqRecord(Seq.Seq(consensus), id=SampleName + \
     '_count_' + str(TotalCount), description='')
     ConsensusAlignment.append(SeqObject)
@@ -1379,8 +1534,488 @@ NumMLtreesMade = 0
 
 HaveWarnedNoQualities = False
 
-# Iterate through the windows
-for window in range(NumCoords / 2):
+def ReadIsWanted(read):
+  '''Returns False for reads from a bam file that we never want (in any window),
+  True otherwise. Reads lacking base qualities are given them.'''
+
+  global HaveWarnedNoQualities
+
+  # fetch isn't supposed to return unmapped reads, but does.
+  if read.is_unmapped:
+    return False
+
+  # Skip improperly paired reads if desired
+  if args.discard_improper_pairs and read.is_paired and \
+  not read.is_proper_pair:
+    return False
+
+  # Skip supplementary read alignments
+  if read.is_supplementary:
+    return False
+
+  if not read.query_qualities:
+    read.query_qualities = [106 for base in range(len(read.query_sequence))]
+    if not HaveWarnedNoQualities:
+      print('Warning: found a read with no information about base',
+      'qualities. All bases will be set to have quality 106 for this read',
+      'and any others lacking this information found henceforth.',
+      file=sys.stderr)
+      if QualTrimEnds or ImposeMinQual: 
+        print('WARNING: you have specified at least one option relating to',
+        'read quality, when read quality information is missing. This is',
+        'strongly discouraged. Continuing nonetheless.', file=sys.stderr)
+      HaveWarnedNoQualities = True
+
+  return True
+
+class ReadCollector(object):
+  '''Collects the reads from one bam file that we want in one window, counting
+  the unique sequences they give in the window after processing.
+
+  Reads are given one at a time to AddRead, in the order in which they are found
+  in the bam file; Finish is called once they all have been. This can be done by
+  CollectFromBam, which fetches the reads overlapping the window, or by
+  CollectReadsInAllWindows, which passes once through the whole bam file giving
+  each read to every window it overlaps. The results are in the attributes
+  UniqueReads, ReadNames, CorrespondenceDict_RawSeqToReadNames and
+  DiscardedReadPairs.
+
+  To forbid the reuse of reads between consecutive overlapping windows, give the
+  set of names of reads used from this bam in this window (which will be added
+  to) and in the last window (which should be empty if the last window does not
+  overlap this one).'''
+
+  def __init__(self, window, WhichBam, ReadNamesInThisWindow=None,
+  ReadNamesInLastWindow=None):
+
+    # Recall some things we've already worked out for this bam file and stored.
+    self.BamFileName = BamFiles[WhichBam]
+    self.BamFileBasename = BamFileBasenames[WhichBam]
+    self.RefSeqName = BamFileRefSeqNames[self.BamFileBasename]
+    ThisBamCoords = CoordsInRefs[BamAliases[WhichBam]]
+    LeftWindowEdge  = ThisBamCoords[window*2]
+    RightWindowEdge = ThisBamCoords[window*2 +1]
+
+    # Pysam uses zero-based coordinates for positions w.r.t the reference.
+    # If we want all reads that start exactly at the window start and end
+    # anywhere after, or all reads that end exactly at the window end and start
+    # anywhere before, set end=start or start=end respectively, to make sure
+    # pysam's fetch function retrieves all the reads we need.
+    LeftWindowEdge  = LeftWindowEdge  -1
+    RightWindowEdge = RightWindowEdge -1
+    LeftWindowEdgeForFetch = LeftWindowEdge
+    RightWindowEdgeForFetch = RightWindowEdge
+    if args.exact_window_start:
+      if not args.exact_window_end:
+        RightWindowEdgeForFetch = None
+        RightWindowEdge = LeftWindowEdge
+    elif args.exact_window_end:
+      LeftWindowEdgeForFetch = None
+      LeftWindowEdge = RightWindowEdge
+    self.LeftWindowEdge = LeftWindowEdge
+    self.RightWindowEdge = RightWindowEdge
+    self.LeftWindowEdgeForFetch = LeftWindowEdgeForFetch
+    self.RightWindowEdgeForFetch = RightWindowEdgeForFetch
+
+    self.ReadNamesInThisWindow = ReadNamesInThisWindow
+    self.ReadNamesInLastWindow = ReadNamesInLastWindow
+
+    self.AllReads = {}
+    self.UniqueReads = {}
+    self.ReadNames = []
+    self.CorrespondenceDict_RawSeqToReadNames = {}
+    self.DiscardedReadPairs = []
+
+  def CollectFromBam(self):
+    '''Fetches the reads overlapping the window from the bam file and collects
+    them.'''
+    BamFile = GetBamFile(self.BamFileName)
+    for read in BamFile.fetch(self.RefSeqName, self.LeftWindowEdgeForFetch,
+    self.RightWindowEdgeForFetch):
+      if ReadIsWanted(read):
+        self.AddRead(read)
+    self.Finish()
+
+  def RecordSeq(self, seq, ReadName):
+    '''Counts one more occurrence of a processed read.'''
+    if seq in self.UniqueReads:
+      self.UniqueReads[seq] += 1
+    else:
+      self.UniqueReads[seq] = 1
+
+    # Record the read name if desired.
+    if args.read_names_1:
+      self.ReadNames.append(ReadName)
+    if args.read_names_2:
+      if seq in self.CorrespondenceDict_RawSeqToReadNames:
+        self.CorrespondenceDict_RawSeqToReadNames[seq].append(ReadName)
+      else:
+        self.CorrespondenceDict_RawSeqToReadNames[seq] = [ReadName]
+
+  def AddRead(self, read):
+    '''Collects one read (a pysam.AlignedSegment instance).'''
+
+    if args.merge_paired_reads:
+
+      # If we've seen this read's mate already, merge the pair.
+      if read.query_name in self.AllReads:
+        Read1 = self.AllReads[read.query_name]
+        try:
+          Read1asPseudoRead = pf.PseudoRead.InitFromRead(Read1)
+        except AttributeError:
+          # An attribute error will arise if we encounter the same name three
+          # times; check if that's the issue and print a more helpful exit
+          # message, otherwise just raise.
+          # (Use a new handle, so as not to disturb the one being read.)
+          ReadCounts = {}
+          BamFile = pysam.AlignmentFile(self.BamFileName, "rb")
+          for NewRead in BamFile.fetch(self.RefSeqName):
+            if NewRead.query_name in ReadCounts:
+              if ReadCounts[NewRead.query_name] == 2:
+                print('The name', NewRead.query_name, 'occurs (at least) 3',
+                'times in', self.BamFileBasename + '; this should never',
+                'happen - the same name should only be found for the two',
+                'reads in a pair. Quitting.', file=sys.stderr)
+                exit(1)
+              else:
+                ReadCounts[NewRead.query_name] += 1
+            else:
+              ReadCounts[NewRead.query_name] = 1
+          print('Encountered an error related to converting reads from pysam',
+          "format to phyloscanner's format, for this read:", read,
+          "\nPlease report to Chris Wymant. Quitting.", file=sys.stderr)
+          raise
+        Read2 = read
+        Read2asPseudoRead = pf.PseudoRead.InitFromRead(read)
+        MergedRead = Read1asPseudoRead.MergeReadPairOverWindow(
+        Read2asPseudoRead, self.LeftWindowEdge, self.RightWindowEdge,
+        args.quality_trim_ends, args.min_internal_quality,
+        args.recover_clipped_ends)
+        if MergedRead == None:
+          del self.AllReads[read.query_name]
+          return
+        elif MergedRead == False:
+          del self.AllReads[read.query_name]
+          if args.inspect_disagreeing_overlaps:
+            self.DiscardedReadPairs += [Read1,Read2]
+          return
+        self.AllReads[read.query_name] = MergedRead
+
+      # We've not come across a read with this name before. Record & move on.
+      # Note that we need to save the read, rather than the pseudoread, in
+      # case
+      else:
+        self.AllReads[read.query_name] = read
+
+    # If we're not merging paired reads, process this read now to save memory.
+    # ProcessRead returns None if we don't want to consider this read.
+    else:
+      ReadAsPseudoRead = pf.PseudoRead.InitFromRead(read)
+      seq = ReadAsPseudoRead.ProcessRead(self.LeftWindowEdge,
+        self.RightWindowEdge, args.quality_trim_ends,
+        args.min_internal_quality, args.keep_overhangs,
+        args.recover_clipped_ends, args.exact_window_start,
+        args.exact_window_end)
+      if seq == None:
+        return
+
+      # We're not merging read pairs here, so we could see the same read name
+      # more than once in the same window, in which case skip it. Then, add
+      # the read name to this window's list, even if we don't use it
+      # because it was in the last window. Otherwise, if a read was in three
+      # consecutive windows, we'd skip it in the second and think we were OK
+      # to use it again in the third.
+      if args.forbid_read_repeats:
+        if read.query_name in self.ReadNamesInThisWindow:
+          return
+        self.ReadNamesInThisWindow.add(read.query_name)
+        if read.query_name in self.ReadNamesInLastWindow:
+          return
+
+      self.RecordSeq(seq, read.query_name)
+
+  def Finish(self):
+    '''Processes reads held back for merging with their mates.'''
+
+    # If we did merge paired reads, we now need to process them.
+    # AllReads will be a mixture of PseudoRead instances (for merged read pairs)
+    # and pysam.AlignedSegment instances (for unmerged single reads). The latter
+    # must be converted to PseudoRead instances to be processed.
+    if args.merge_paired_reads:
+      for read in self.AllReads.values():
+        try:
+          seq = read.ProcessRead(self.LeftWindowEdge, self.RightWindowEdge,
+          args.quality_trim_ends, args.min_internal_quality,
+          args.keep_overhangs, args.recover_clipped_ends,
+          args.exact_window_start, args.exact_window_end)
+        except AttributeError:
+          ReadAsPseudoRead = pf.PseudoRead.InitFromRead(read)          
+          seq = ReadAsPseudoRead.ProcessRead(self.LeftWindowEdge,
+          self.RightWindowEdge, args.quality_trim_ends,
+          args.min_internal_quality, args.keep_overhangs,
+          args.recover_clipped_ends, args.exact_window_start,
+          args.exact_window_end)
+          ReadName = read.query_name
+        else:
+          ReadName = read.name
+        if seq == None:
+          continue
+
+        # Check if we've seen this merged read pair in the last window.
+        if args.forbid_read_repeats:
+          self.ReadNamesInThisWindow.add(ReadName)
+          if ReadName in self.ReadNamesInLastWindow:
+            continue
+
+        self.RecordSeq(seq, ReadName)
+
+    # The unprocessed reads are no longer needed.
+    self.AllReads = None
+
+def CollectReadsInAllWindows():
+  '''Passes once through each bam file, giving each read to the collector of
+  every window it overlaps. Returns a list with one item per window, each being
+  a list of collectors with one per bam file.'''
+
+  ReadCollectorsByWindow = [[] for window in range(NumWindows)]
+  for i,BamFileName in enumerate(BamFiles):
+
+    if args.verbose:
+      print('Now extracting reads for all windows from bam', BamAliases[i] + \
+      '.')
+
+    # A read is wanted in a window if it overlaps the region that would be
+    # fetched for that window (i.e. it starts before the fetch end and ends
+    # after the fetch start; None means unbounded). Windows waiting for reads to
+    # reach them are sorted by where they start; windows are active from when
+    # a read may first overlap them until reads start after their end, when
+    # they are finished. As reads come sorted by start position, a window
+    # finished will never be overlapped by a later read.
+    WaitingCollectors = []
+    for window in range(NumWindows):
+      collector = ReadCollector(window, i)
+      ReadCollectorsByWindow[window].append(collector)
+      if collector.LeftWindowEdgeForFetch == None:
+        collector.FetchStart = 0
+      else:
+        collector.FetchStart = collector.LeftWindowEdgeForFetch
+      collector.FetchEnd = collector.RightWindowEdgeForFetch
+      WaitingCollectors.append(collector)
+    WaitingCollectors.sort(key=lambda collector: collector.FetchStart)
+    NumWaiting = len(WaitingCollectors)
+    NextWaiting = 0
+    ActiveCollectors = []
+
+    RefSeqName = BamFileRefSeqNames[BamFileBasenames[i]]
+    BamFile = GetBamFile(BamFileName)
+    for read in BamFile.fetch(RefSeqName):
+
+      if not ReadIsWanted(read):
+        continue
+
+      # Reads without any aligned bases are treated as having length 1, as in
+      # fetching.
+      ReadStart = read.reference_start
+      ReadEnd = read.reference_end
+      if ReadEnd == None or ReadEnd <= ReadStart:
+        ReadEnd = ReadStart + 1
+
+      while NextWaiting < NumWaiting and \
+      WaitingCollectors[NextWaiting].FetchStart < ReadEnd:
+        ActiveCollectors.append(WaitingCollectors[NextWaiting])
+        NextWaiting += 1
+
+      StillActiveCollectors = []
+      for collector in ActiveCollectors:
+        if collector.FetchEnd != None and collector.FetchEnd <= ReadStart:
+          collector.Finish()
+          continue
+        StillActiveCollectors.append(collector)
+        if ReadEnd > collector.FetchStart:
+          collector.AddRead(read)
+      ActiveCollectors = StillActiveCollectors
+
+    for collector in ActiveCollectors + WaitingCollectors[NextWaiting:]:
+      collector.Finish()
+
+  return ReadCollectorsByWindow
+
+def EmptyWindowOutput():
+  '''Returns a dict for recording what is produced in one window.
+
+  As well as the files and data produced, this records (for the run manifest)
+  the window, which output files were produced in which stage of processing it,
+  the file that trees are to be made from (if any), and the stage in which an
+  external program failed (if any), so that the window can be retried.'''
+  return {'TempFiles' : set([]), 'NumMLtreesMade' : 0, 'ExplorationData' : [],
+  'OutputFiles' : {DirKey:[] for DirKey in OutputFilesByDestinationDir},
+  'Window' : None, 'Stages' : [], 'FileForTrees' : None, 'FailedStage' : None}
+
+def CloseWindowStage(WindowOutput):
+  '''Records the output files made in a window and not yet recorded for any
+  stage of processing it as belonging to the current stage.'''
+  if WindowOutput['Stages'] == []:
+    return
+  FilesInStages = set(itertools.chain.from_iterable(
+  files for StageName, files in WindowOutput['Stages']))
+  for File in itertools.chain.from_iterable(
+  WindowOutput['OutputFiles'].values()):
+    if not File in FilesInStages:
+      WindowOutput['Stages'][-1][1].append(File)
+      FilesInStages.add(File)
+
+def StartWindowStage(WindowOutput, StageName):
+  '''Records the start of the named stage of processing a window.'''
+  CloseWindowStage(WindowOutput)
+  WindowOutput['Stages'].append([StageName, []])
+
+def RAxMLFilesForWindow(WindowSuffix):
+  '''Returns the names of the files made by RAxML for a window.'''
+  return sorted(glob.glob('RAxML_*' + WindowSuffix + '[._]*'))
+
+def RecordWindowInManifest(WindowOutput):
+  '''Records what one window produced, and a checksum of each output file, in
+  the run manifest, which is rewritten.'''
+  CloseWindowStage(WindowOutput)
+  entry = {'Fingerprint' : ProcessingFingerprint,
+  'TreesFingerprint' : TreesFingerprint,
+  'Stages' : [[StageName, {File : pf.FileChecksum(File) for File in files}] \
+  for StageName, files in WindowOutput['Stages']],
+  'OutputFiles' : WindowOutput['OutputFiles'],
+  'TempFiles' : sorted(WindowOutput['TempFiles']),
+  'ExplorationData' : WindowOutput['ExplorationData'],
+  'NumMLtreesMade' : WindowOutput['NumMLtreesMade'],
+  'FileForTrees' : WindowOutput['FileForTrees'],
+  'FailedStage' : WindowOutput['FailedStage']}
+  ManifestWindows[WindowOutput['Window']] = entry
+  manifest = {'Inputs' : InputsDescription,
+  'Fingerprint' : ProcessingFingerprint, 'Windows' : ManifestWindows}
+  # Write to another file and then rename it, so that the manifest is never
+  # left half-written.
+  with open(FileForRunManifest + '.tmp', 'w') as f:
+    json.dump(manifest, f, indent=1, sort_keys=True)
+  os.rename(FileForRunManifest + '.tmp', FileForRunManifest)
+  TempFiles.add(FileForRunManifest)
+
+def RecordWindowOutput(WindowOutput):
+  '''Adds what was produced in one window to the records for the whole run.'''
+  global NumMLtreesMade
+  TempFiles.update(WindowOutput['TempFiles'])
+  NumMLtreesMade += WindowOutput['NumMLtreesMade']
+  if ExploreWindowWidths:
+    WindowWidthExplorationData.extend(WindowOutput['ExplorationData'])
+  for DirKey, files in WindowOutput['OutputFiles'].items():
+    OutputFilesByDestinationDir[DirKey].extend(files)
+  if WindowOutput['Window'] != None:
+    RecordWindowInManifest(WindowOutput)
+
+def ResumeWindow(WindowOutput):
+  '''Checks whether an earlier run recorded in the manifest processed this
+  window with the same inputs and options, with its output files unchanged.
+
+  Returns 'complete' if the window needs no more work, 'trees' if only its trees
+  need to be made (again), or None if it needs to be processed from scratch. In
+  the first two cases the window's output is copied from the manifest into
+  WindowOutput (all except the trees in the second case). A window in which an
+  external program failed is retried from the stage that failed.'''
+  try:
+    entry = ResumedManifestWindows[WindowOutput['Window']]
+  except KeyError:
+    return None
+  if entry['Fingerprint'] != ProcessingFingerprint:
+    return None
+  FailedStage = entry.get('FailedStage')
+  if not FailedStage in (None, 'trees'):
+    return None
+  for StageName, checksums in entry['Stages']:
+    if StageName == 'trees':
+      continue
+    for File, checksum in checksums.items():
+      if checksum == None or pf.FileChecksum(File) != checksum:
+        return None
+
+  # The trees are fine if there were meant to be none, or if they were made with
+  # the same options and are unchanged.
+  TreesNeeded = not args.no_trees and entry['FileForTrees'] != None
+  TreesAreFine = not TreesNeeded
+  if TreesNeeded and entry['TreesFingerprint'] == TreesFingerprint and \
+  FailedStage == None:
+    for StageName, checksums in entry['Stages']:
+      if StageName == 'trees':
+        TreesAreFine = all(checksum != None and \
+        pf.FileChecksum(File) == checksum for File, checksum in \
+        checksums.items())
+
+  WindowOutput['OutputFiles'] = entry['OutputFiles']
+  WindowOutput['TempFiles'] = set(File for File in entry['TempFiles'] \
+  if os.path.isfile(File))
+  WindowOutput['ExplorationData'] = entry['ExplorationData']
+  WindowOutput['FileForTrees'] = entry['FileForTrees']
+  WindowOutput['Stages'] = [[StageName, sorted(checksums)] for \
+  StageName, checksums in entry['Stages'] if StageName != 'trees' or \
+  TreesAreFine]
+  if TreesAreFine:
+    WindowOutput['NumMLtreesMade'] = entry['NumMLtreesMade']
+    return 'complete'
+  return 'trees'
+
+def MakeTreesForWindow(WindowOutput, WindowSuffix, WindowAsStr, LeftEdge,
+RightEdge, WindowTimes):
+  '''Makes the ML tree (and bootstrapped trees, if desired) with RAxML for a
+  window whose reads have been processed.'''
+  StartWindowStage(WindowOutput, 'trees')
+
+  # If we're resuming, RAxML files for this window may have been left by the
+  # earlier run, and RAxML refuses to overwrite files.
+  if args.resume:
+    for File in RAxMLFilesForWindow(WindowSuffix):
+      os.remove(File)
+
+  if PrintInfo:
+    print('Running RAxML on the processed & aligned reads in window',
+    WindowAsStr)
+
+  WindowOutput['NumMLtreesMade'] = pf.RunRAxML(WindowOutput['FileForTrees'],
+  RAxMLargList, WindowSuffix, WindowAsStr, LeftEdge, RightEdge,
+  WindowOutput['TempFiles'],
+  TempFileForAllBootstrappedTrees_basename, args.bootstrap_seed,
+  args.num_bootstraps, WindowTimes, NumBootstrapSlots, ExternalToolSlots)
+  WindowOutput['Stages'][-1][1].extend(RAxMLFilesForWindow(WindowSuffix))
+
+  # Record whether RAxML failed to make the ML tree or the bootstraps, so that
+  # the trees are made again if resuming.
+  if WindowOutput['NumMLtreesMade'] == 0 or (args.num_bootstraps != None and \
+  not os.path.isfile('RAxML_bipartitions.MLtreeWbootstraps' + WindowSuffix + \
+  '.tree')):
+    WindowOutput['FailedStage'] = 'trees'
+  else:
+    WindowOutput['FailedStage'] = None
+
+def ProcessWindowInStages(window, WindowOutput):
+  '''Extracts, processes and aligns the reads in one window, and makes trees.
+
+  This is a generator with two stages: the first (up to the one yield) reads
+  and pre-processes the reads in the window, and the second aligns them with
+  mafft, post-processes the alignment and makes trees with RAxML. This allows
+  the scheduler to run the second stage in another thread while the first stage
+  of the next window is run. Windows must go through the first stage in order,
+  one at a time, since that stage updates information shared between windows.
+
+  The temporary and output files created, the number of ML trees made, and any
+  window-width exploration data, are recorded in WindowOutput (a dict created
+  with EmptyWindowOutput) instead of in the records for the whole run, so that
+  windows can be processed in separate processes or threads.'''
+
+  global AllPatientsReadNamesInThisWindow, ThisWindow
+  TempFilesHere = WindowOutput['TempFiles']
+  OutputFilesHere = WindowOutput['OutputFiles']
+  ExplorationDataHere = WindowOutput['ExplorationData']
+
+  # The times taken by the steps for this window.
+  WindowTimes = []
+  if args.time:
+    WindowTimes.append(time.time())
+
 
   # If coords were specified with respect to one particular reference,
   # WindowCoords is the translation of those coords to alignment coordinates.
@@ -1391,6 +2026,28 @@ for window in range(NumCoords / 2):
   ThisWindowSuffix = 'InWindow_'+str(UserLeftWindowEdge)+'_to_'+\
   str(UserRightWindowEdge)
   ThisWindowAsStr = str(UserLeftWindowEdge) + '-' + str(UserRightWindowEdge)
+  WindowOutput['Window'] = ThisWindowAsStr
+
+  # If we're resuming a previous run, see what remains to be done here.
+  if args.resume:
+    ResumeStatus = ResumeWindow(WindowOutput)
+    if ResumeStatus != None and args.read_bams_once:
+      ReadCollectorsByWindow[window] = None
+    if ResumeStatus == 'complete':
+      if PrintInfo:
+        print('Window', ThisWindowAsStr, 'was completed by an earlier run;',
+        'reusing its output.')
+      return
+    if ResumeStatus == 'trees':
+      if PrintInfo:
+        print('The reads in window', ThisWindowAsStr, 'were processed by an',
+        'earlier run; making only its trees.')
+      yield
+      MakeTreesForWindow(WindowOutput, ThisWindowSuffix, ThisWindowAsStr,
+      UserLeftWindowEdge, UserRightWindowEdge, WindowTimes)
+      return
+
+  StartWindowStage(WindowOutput, 'reads')
 
   if PrintInfo:
     print('Now extracting and processing reads in window', ThisWindowAsStr)
@@ -1434,14 +2091,8 @@ for window in range(NumCoords / 2):
   # Iterate through the bam files
   for i,BamFileName in enumerate(BamFiles):
 
-    # Recall some things we've already worked out for this bam file and stored.
     BamFileBasename = BamFileBasenames[i]
-    RefSeqName = BamFileRefSeqNames[BamFileBasename]
-    RefLength = BamFileRefLengths[BamFileBasename]
     BamAlias = BamAliases[i]
-    ThisBamCoords = CoordsInRefs[BamAlias]
-    LeftWindowEdge  = ThisBamCoords[window*2]
-    RightWindowEdge = ThisBamCoords[window*2 +1]
 
     if args.verbose:
       print('Now extracting & processing reads from bam', BamAlias + '.')
@@ -1450,194 +2101,34 @@ for window in range(NumCoords / 2):
     FileForReadNames1_basename_ThisBam = FileForReadNames1_basename + \
     ThisWindowSuffix + '_InBam_'
 
-    # Pysam uses zero-based coordinates for positions w.r.t the reference.
-    # If we want all reads that start exactly at the window start and end
-    # anywhere after, or all reads that end exactly at the window end and start
-    # anywhere before, set end=start or start=end respectively, to make sure
-    # pysam's fetch function retrieves all the reads we need.
-    LeftWindowEdge  = LeftWindowEdge  -1
-    RightWindowEdge = RightWindowEdge -1
-    LeftWindowEdgeForFetch = LeftWindowEdge
-    RightWindowEdgeForFetch = RightWindowEdge
-    if args.exact_window_start:
-      if not args.exact_window_end:
-        RightWindowEdgeForFetch = None
-        RightWindowEdge = LeftWindowEdge
-    elif args.exact_window_end:
-      LeftWindowEdgeForFetch = None
-      LeftWindowEdge = RightWindowEdge
-
-    # Find all unique reads in this window and count their occurrences.
-    AllReads = {}
-    UniqueReads = {}
-    ReadNames = []
-    CorrespondenceDict_RawSeqToReadNames = {}
-    BamFile = pysam.AlignmentFile(BamFileName, "rb")
-    for read in BamFile.fetch(RefSeqName, LeftWindowEdgeForFetch,
-    RightWindowEdgeForFetch):
-
-      # fetch isn't supposed to return unmapped reads, but does.
-      if read.is_unmapped:
-        continue
-
-      # Skip improperly paired reads if desired
-      if args.discard_improper_pairs and read.is_paired and \
-      not read.is_proper_pair:
-        continue
-
-      # Skip supplementary read alignments
-      if read.is_supplementary:
-        continue
-
-      if not read.query_qualities:
-        read.query_qualities = [106 for base in range(len(read.query_sequence))]
-        if not HaveWarnedNoQualities:
-          print('Warning: found a read with no information about base',
-          'qualities. All bases will be set to have quality 106 for this read',
-          'and any others lacking this information found henceforth.',
-          file=sys.stderr)
-          if QualTrimEnds or ImposeMinQual: 
-            print('WARNING: you have specified at least one option relating to',
-            'read quality, when read quality information is missing. This is',
-            'strongly discouraged. Continuing nonetheless.', file=sys.stderr)
-          HaveWarnedNoQualities = True
-
-      if args.merge_paired_reads:
-
-        # If we've seen this read's mate already, merge the pair.
-        if read.query_name in AllReads:
-          Read1 = AllReads[read.query_name]
-          try:
-            Read1asPseudoRead = pf.PseudoRead.InitFromRead(Read1)
-          except AttributeError:
-            # An attribute error will arise if we encounter the same name three
-            # times; check if that's the issue and print a more helpful exit
-            # message, otherwise just raise.
-            ReadCounts = {}
-            for NewRead in BamFile.fetch(RefSeqName):
-              if NewRead.query_name in ReadCounts:
-                if ReadCounts[NewRead.query_name] == 2:
-                  print('The name', NewRead.query_name, 'occurs (at least) 3',
-                  'times in', BamFileBasename + '; this should never happen -',
-                  'the same name should only be found for the two reads in a',
-                  'pair. Quitting.', file=sys.stderr)
-                  exit(1)
-                else:
-                  ReadCounts[NewRead.query_name] += 1
-              else:
-                ReadCounts[NewRead.query_name] = 1
-            print('Encountered an error related to converting reads from pysam',
-            "format to phyloscanner's format, for this read:", read,
-            "\nPlease report to Chris Wymant. Quitting.", file=sys.stderr)
-            raise
-          Read2 = read
-          Read2asPseudoRead = pf.PseudoRead.InitFromRead(read)
-          MergedRead = Read1asPseudoRead.MergeReadPairOverWindow(
-          Read2asPseudoRead, LeftWindowEdge, RightWindowEdge,
-          args.quality_trim_ends, args.min_internal_quality,
-          args.recover_clipped_ends)
-          if MergedRead == None:
-            del AllReads[read.query_name]
-            continue
-          elif MergedRead == False:
-            del AllReads[read.query_name]
-            if args.inspect_disagreeing_overlaps:
-              DiscardedReadPairsDict[BamFileBasename] += [Read1,Read2]
-            continue
-          AllReads[read.query_name] = MergedRead
-
-        # We've not come across a read with this name before. Record & move on.
-        # Note that we need to save the read, rather than the pseudoread, in
-        # case
+    # Find all unique reads in this window and count their occurrences: either
+    # we collected these already, passing once through every bam file for all
+    # windows, or we collect them now.
+    if args.read_bams_once:
+      collector = ReadCollectorsByWindow[window][i]
+      ReadCollectorsByWindow[window][i] = None
+    else:
+      if args.forbid_read_repeats:
+        if OverlapsLastWindow:
+          ReadNamesInLastWindow = AllPatientsReadNamesInLastWindow[BamFileName]
         else:
-          AllReads[read.query_name] = read
-
-      # If we're not merging paired reads, process this read now to save memory.
-      # ProcessRead returns None if we don't want to consider this read.
+          ReadNamesInLastWindow = set([])
+        collector = ReadCollector(window, i,
+        AllPatientsReadNamesInThisWindow[BamFileName], ReadNamesInLastWindow)
       else:
-        ReadAsPseudoRead = pf.PseudoRead.InitFromRead(read)
-        seq = ReadAsPseudoRead.ProcessRead(LeftWindowEdge, RightWindowEdge,
-          args.quality_trim_ends, args.min_internal_quality,
-          args.keep_overhangs, args.recover_clipped_ends,
-          args.exact_window_start, args.exact_window_end)
-        if seq == None:
-          continue
-
-        # We're not merging read pairs here, so we could see the same read name
-        # more than once in the same window, in which case skip it. Then, add
-        # the read name to this window's list, even if we don't use it
-        # because it was in the last window. Otherwise, if a read was in three
-        # consecutive windows, we'd skip it in the second and think we were OK
-        # to use it again in the third.
-        if args.forbid_read_repeats:
-          if read.query_name in AllPatientsReadNamesInThisWindow[BamFileName]:
-            continue
-          AllPatientsReadNamesInThisWindow[BamFileName].add(read.query_name)
-          if OverlapsLastWindow and \
-          read.query_name in AllPatientsReadNamesInLastWindow[BamFileName]:
-            continue
-
-        if seq in UniqueReads:
-          UniqueReads[seq] += 1
-        else:
-          UniqueReads[seq] = 1
-
-        # Record the read name if desired.
-        if args.read_names_1:
-          ReadNames.append(read.query_name)
-        if args.read_names_2:
-          if seq in CorrespondenceDict_RawSeqToReadNames:
-            CorrespondenceDict_RawSeqToReadNames[seq].append(read.query_name)
-          else:
-            CorrespondenceDict_RawSeqToReadNames[seq] = [read.query_name]
-
-    # If we did merge paired reads, we now need to process them.
-    # AllReads will be a mixture of PseudoRead instances (for merged read pairs)
-    # and pysam.AlignedSegment instances (for unmerged single reads). The latter
-    # must be converted to PseudoRead instances to be processed.
-    if args.merge_paired_reads:
-      for read in AllReads.values():
-        try:
-          seq = read.ProcessRead(LeftWindowEdge, RightWindowEdge,
-          args.quality_trim_ends, args.min_internal_quality,
-          args.keep_overhangs, args.recover_clipped_ends,
-          args.exact_window_start, args.exact_window_end)
-        except AttributeError:
-          #print(type(read))
-          ReadAsPseudoRead = pf.PseudoRead.InitFromRead(read)          
-          seq = ReadAsPseudoRead.ProcessRead(LeftWindowEdge, RightWindowEdge,
-          args.quality_trim_ends, args.min_internal_quality,
-          args.keep_overhangs, args.recover_clipped_ends,
-          args.exact_window_start, args.exact_window_end)
-          ReadName = read.query_name
-        else:
-          ReadName = read.name
-        if seq == None:
-          continue
-
-        # Check if we've seen this merged read pair in the last window.
-        if args.forbid_read_repeats:
-          AllPatientsReadNamesInThisWindow[BamFileName].add(ReadName)
-          if OverlapsLastWindow and \
-          ReadName in AllPatientsReadNamesInLastWindow[BamFileName]:
-            continue
-
-        if seq in UniqueReads:
-          UniqueReads[seq] += 1
-        else:
-          UniqueReads[seq] = 1
-
-        # Record the read name if desired.
-        if args.read_names_1:
-          ReadNames.append(ReadName)
-        if args.read_names_2:
-          if seq in CorrespondenceDict_RawSeqToReadNames:
-            CorrespondenceDict_RawSeqToReadNames[seq].append(ReadName)
-          else:
-            CorrespondenceDict_RawSeqToReadNames[seq] = [ReadName]
+        collector = ReadCollector(window, i)
+      collector.CollectFromBam()
+    UniqueReads = collector.UniqueReads
+    ReadNames = collector.ReadNames
+    CorrespondenceDict_RawSeqToReadNames = \
+    collector.CorrespondenceDict_RawSeqToReadNames
+    LeftWindowEdge = collector.LeftWindowEdge
+    RightWindowEdge = collector.RightWindowEdge
+    if args.inspect_disagreeing_overlaps:
+      DiscardedReadPairsDict[BamFileBasename] += collector.DiscardedReadPairs
 
     if ExploreWindowWidthsFast:
-      WindowWidthExplorationData.append([UserLeftWindowEdge,
+      ExplorationDataHere.append([UserLeftWindowEdge,
       UserRightWindowEdge, BamAlias, len(UniqueReads)])
       continue
 
@@ -1684,52 +2175,69 @@ for window in range(NumCoords / 2):
       FileForReadNames1 = FileForReadNames1_basename_ThisBam + BamAlias + '.txt'
       with open(FileForReadNames1, 'w') as f:
         f.write('\n'.join(ReadNames) + '\n')
-      OutputFilesByDestinationDir['ReadNames'].append(FileForReadNames1)
+      OutputFilesHere['ReadNames'].append(FileForReadNames1)
     if args.read_names_2:
       CorrespondenceDict_RawSeqToReadNames_AllSamples[BamAlias] = \
       CorrespondenceDict_RawSeqToReadNames
   if args.read_names_only:
-    continue
+    return
 
   # We've now gathered together reads from all bam files for this window.
 
   # If we're checking for duplicate reads between samples, do so now.
   # Check every dict against every other dict, and record the ratio of counts
-  # for any shared reads.
+  # for any shared reads. Rather than comparing every pair of dicts, we first
+  # index the reads by which dicts contain them, in one pass through all dicts.
+  # Then for each dict, we find each later dict sharing reads with it, and the
+  # shared reads in the order they are found in the first dict; this is the
+  # order in which pairs of dicts and their shared reads are considered.
   if CheckDuplicates:
     if args.verbose:
       print('Now checking for duplication of reads between bam files.')
     DuplicateDetails = []
     ContaminantReadsFound = {}
+    DictsContainingRead = {}
+    for i, (BamAlias, ReadDict, LeftWindowEdge, RightWindowEdge) \
+    in enumerate(AllReadDictsInThisWindow):
+      for read in ReadDict:
+        if read in DictsContainingRead:
+          DictsContainingRead[read].append(i)
+        else:
+          DictsContainingRead[read] = [i]
     for i, (BamFile1Alias, ReadDict1, LeftWindowEdge1, RightWindowEdge1) \
     in enumerate(AllReadDictsInThisWindow):
-      for j, (BamFile2Alias, ReadDict2, LeftWindowEdge2, RightWindowEdge2) \
-      in enumerate(AllReadDictsInThisWindow[i+1:]):
-        DuplicateReadRatios = []
-        for read in ReadDict1:
-          if read in ReadDict2:
-            Bam1Count = ReadDict1[read]
-            Bam2Count = ReadDict2[read]
-            DuplicateDetails.append(
-            (BamFile1Alias, BamFile2Alias, Bam1Count, Bam2Count))
-
-            # Diagnose contaminants
-            if FlagContaminants:
-              CountRatio = float(Bam1Count) / Bam2Count
-              ContaminantAlias = None
-              if CountRatio >= args.contaminant_count_ratio:
-                ContaminantAlias = BamFile2Alias
-              elif CountRatio <= 1. / args.contaminant_count_ratio:
-                ContaminantAlias = BamFile1Alias
-              if ContaminantAlias != None:
-                if ContaminantAlias in ContaminantReadsFound:
-                  # It's possible this read for this patient is considered
-                  # contamination from more than one source, so check the read
-                  # isn't there already before adding it to the list:
-                  if not read in ContaminantReadsFound[ContaminantAlias]:
-                    ContaminantReadsFound[ContaminantAlias].append(read)
-                else:
-                  ContaminantReadsFound[ContaminantAlias] = [read]
+      SharedReadsByLaterDict = collections.defaultdict(list)
+      for read in ReadDict1:
+        DictsContainingThisRead = DictsContainingRead[read]
+        if len(DictsContainingThisRead) > 1:
+          for j in DictsContainingThisRead[
+          DictsContainingThisRead.index(i) + 1:]:
+            SharedReadsByLaterDict[j].append(read)
+      for j in sorted(SharedReadsByLaterDict):
+        BamFile2Alias, ReadDict2 = AllReadDictsInThisWindow[j][:2]
+        for read in SharedReadsByLaterDict[j]:
+          Bam1Count = ReadDict1[read]
+          Bam2Count = ReadDict2[read]
+          DuplicateDetails.append(
+          (BamFile1Alias, BamFile2Alias, Bam1Count, Bam2Count))
+
+          # Diagnose contaminants
+          if FlagContaminants:
+            CountRatio = float(Bam1Count) / Bam2Count
+            ContaminantAlias = None
+            if CountRatio >= args.contaminant_count_ratio:
+              ContaminantAlias = BamFile2Alias
+            elif CountRatio <= 1. / args.contaminant_count_ratio:
+              ContaminantAlias = BamFile1Alias
+            if ContaminantAlias != None:
+              if ContaminantAlias in ContaminantReadsFound:
+                # It's possible this read for this patient is considered
+                # contamination from more than one source, so check the read
+                # isn't there already before adding it to the list:
+                if not read in ContaminantReadsFound[ContaminantAlias]:
+                  ContaminantReadsFound[ContaminantAlias].append(read)
+              else:
+                ContaminantReadsFound[ContaminantAlias] = [read]
 
     if DuplicateDetails != []:
       FileForDuplicateReadCountsRaw = FileForDuplicateReadCountsRaw_basename + \
@@ -1738,7 +2246,7 @@ for window in range(NumCoords / 2):
         f.write('"Alias1","Alias2","Count1","Count2"\n')
         f.write('\n'.join(','.join(map(str,data)) for data in \
         DuplicateDetails) + '\n')
-      OutputFilesByDestinationDir['DupData'].append(FileForDuplicateReadCountsRaw)
+      OutputFilesHere['DupData'].append(FileForDuplicateReadCountsRaw)
 
     # If contaminants are diagnosed, print them and remove them from their
     # ReadDict.
@@ -1751,14 +2259,14 @@ for window in range(NumCoords / 2):
           AllContaminants.append(SeqIO.SeqRecord(Seq.Seq(read), id=alias,
           description=''))
       SeqIO.write(AllContaminants, FileForDuplicateSeqs, "fasta")
-      OutputFilesByDestinationDir['DupData'].append(FileForDuplicateSeqs)
+      OutputFilesHere['DupData'].append(FileForDuplicateSeqs)
       for i, (BamAlias, ReadDict, LeftWindowEdge, RightWindowEdge) \
       in enumerate(AllReadDictsInThisWindow):
         if BamAlias in ContaminantReadsFound:
           for read in ContaminantReadsFound[BamAlias]:
             del AllReadDictsInThisWindow[i][1][read]
     if args.flag_contaminants_only:
-      continue
+      return
 
     # Process the read dicts (not yet done if we're checking for duplicates).
     for i, (BamAlias, ReadDict, LeftWindowEdge, RightWindowEdge) \
@@ -1782,7 +2290,7 @@ for window in range(NumCoords / 2):
       pass
     elif ExploreWindowWidths:
       for alias in BamAliases:
-        WindowWidthExplorationData.append([UserLeftWindowEdge,
+        ExplorationDataHere.append([UserLeftWindowEdge,
         UserRightWindowEdge, alias, 0])
     else:
       message = 'WARNING: no bam file had any reads '
@@ -1792,7 +2300,7 @@ for window in range(NumCoords / 2):
       message += 'in the window ' + ThisWindowAsStr + \
       '. Skipping to the next window.'
       print(message, file=sys.stderr)
-    continue
+    return
 
   # Re-define the window edge coords to be with respect to the alignment of refs
   # rather than a bam file.
@@ -1807,7 +2315,7 @@ for window in range(NumCoords / 2):
   ThisWindowSuffix +'.fasta'
   if len(AllReadsInThisWindow) == 1 and not IncludeOtherRefs:
     SeqIO.write(AllReadsInThisWindow, FileForAlnReadsHere, "fasta")
-    OutputFilesByDestinationDir['AlignedReads'].append(FileForAlnReadsHere)
+    OutputFilesHere['AlignedReads'].append(FileForAlnReadsHere)
     # If we're exploring window widths, record that all bams but one have no
     # reads.
     if ExploreWindowWidths:
@@ -1826,15 +2334,20 @@ for window in range(NumCoords / 2):
           count = 1
         else:
           count = 0
-        WindowWidthExplorationData.append([UserLeftWindowEdge,
+        ExplorationDataHere.append([UserLeftWindowEdge,
         UserRightWindowEdge, alias, count])
     else:
       if PrintInfo:
         print('There is only one read in this window, written to ' +\
         FileForAlnReadsHere +'. Skipping to the next window.')
-    continue
-  SeqIO.write(AllReadsInThisWindow, TempFileForReadsHere, "fasta")
-  TempFiles.add(TempFileForReadsHere)
+    return
+  if StreamReadsToMafft:
+    ReadsAsFasta = cStringIO.StringIO()
+    SeqIO.write(AllReadsInThisWindow, ReadsAsFasta, "fasta")
+    ReadsAsFasta = ReadsAsFasta.getvalue()
+  else:
+    SeqIO.write(AllReadsInThisWindow, TempFileForReadsHere, "fasta")
+    TempFilesHere.add(TempFileForReadsHere)
   FileForTrees = FileForAlnReadsHere
 
   # If external refs are included, find the part of each one's seq corresponding
@@ -1857,67 +2370,130 @@ for window in range(NumCoords / 2):
       if len(RefsThatAreNotPureGap) == 0:
         print('Error: all external references are pure gap in this window;',
         'skipping to the next window.', file=sys.stderr)
-        continue
+        return
       AlignIO.write(Align.MultipleSeqAlignment(RefsThatAreNotPureGap),
       TempFileForOtherRefsHere, 'fasta')
-      TempFiles.add(TempFileForOtherRefsHere)
+      TempFilesHere.add(TempFileForOtherRefsHere)
     else:
-      with open(TempFileForOtherRefsHere, 'w') as f:
-        try:
-          ExitStatus = subprocess.call([PythonPath, FindSeqsInFastaCode,
-          FileForAlignedRefs, '-B', '-W', str(LeftWindowEdge) + ',' + \
-          str(RightWindowEdge), '-v'] + BamAliases, stdout=f)
-          assert ExitStatus == 0
-        except:
-          print('Problem calling', FindSeqsInFastaCode+\
-          '. Skipping to the next window.', file=sys.stderr)
-          continue
+      try:
+        RefAlignmentInWindow = pf.AlignmentWindow(AlignedExternalRefs,
+        AlignedExternalRefsMatrix, LeftWindowEdge, RightWindowEdge,
+        SkipBlanks=True)
+      except ValueError as err:
+        print(err, 'Skipping to the next window.', file=sys.stderr)
+        return
+      SeqIO.write(RefAlignmentInWindow, TempFileForOtherRefsHere, 'fasta')
 
   # Update on time taken if desired
   if args.time:
-    times.append(time.time())
-    LastStepTime = times[-1] - times[-2]
+    WindowTimes.append(time.time())
+    LastStepTime = WindowTimes[-1] - WindowTimes[-2]
     print('Read pre-processing in window', ThisWindowAsStr,
     'finished. Number of seconds taken: ', LastStepTime)
 
+  # The first stage of processing this window ends here.
+  yield
+  StartWindowStage(WindowOutput, 'alignment')
+
   # Align the reads. Prepend 'temp_' to the file name if we'll merge again after
   # aligning.
   if MergeReads:
     FileForReads = 'temp_' + FileForAlnReadsHere
-    TempFiles.add(FileForReads)
+    if not args.stream_to_mafft:
+      TempFilesHere.add(FileForReads)
   else:
     FileForReads = FileForAlnReadsHere
+  # When streaming, '-' tells mafft to read the reads from its stdin.
+  if StreamReadsToMafft:
+    FileForUnalignedReads = '-'
+  else:
+    FileForUnalignedReads = TempFileForReadsHere
   if IncludeOtherRefs:
-    FinalMafftOptions = ['--add', TempFileForReadsHere, TempFileForOtherRefsHere]
+    MafftOptions = MafftArgList + ['--quiet', '--preservecase', '--add']
+    MafftInputFiles = [FileForUnalignedReads, TempFileForOtherRefsHere]
   else:
-    FinalMafftOptions = [TempFileForReadsHere]
-  with open(FileForReads, 'w') as f:
-    try:
-      ExitStatus = subprocess.call(MafftArgList + ['--quiet',
-      '--preservecase'] + FinalMafftOptions, stdout=f)
-      assert ExitStatus == 0
-    except:
-      print('Problem calling mafft. Skipping to the next window.',
-      file=sys.stderr)
-      continue
-    if not os.path.isfile(FileForReads):
-      print('Error:', FileForReads +', expected to be produced by mafft, does',
-      'not exist. Skipping to the next window.', file=sys.stderr)
-      continue
+    MafftOptions = MafftArgList + ['--quiet', '--preservecase']
+    MafftInputFiles = [FileForUnalignedReads]
+
+  # If we're caching alignments, look for one made from files with the same
+  # contents (their names differ between windows) and the same options.
+  FoundInCache = False
+  if MafftCache != None:
+    if StreamReadsToMafft:
+      MafftCacheKey = MafftCache.KeyFromChecksums(MafftOptions,
+      [hashlib.md5(ReadsAsFasta).hexdigest()])
+    else:
+      MafftCacheKey = MafftCache.Key(MafftOptions, MafftInputFiles)
+    if args.stream_to_mafft:
+      AlignedReadsAsFasta = MafftCache.FetchData(MafftCacheKey)
+      FoundInCache = AlignedReadsAsFasta != None
+    else:
+      FoundInCache = MafftCache.Fetch(MafftCacheKey, FileForReads)
+    if FoundInCache and args.verbose:
+      print('Reusing the cached alignment of the reads in window',
+      ThisWindowAsStr)
+
+  if args.stream_to_mafft:
+    if not FoundInCache:
+      try:
+        with ExternalToolSlots:
+          if StreamReadsToMafft:
+            proc = subprocess.Popen(MafftOptions + MafftInputFiles,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            AlignedReadsAsFasta = proc.communicate(ReadsAsFasta)[0]
+          else:
+            proc = subprocess.Popen(MafftOptions + MafftInputFiles,
+            stdout=subprocess.PIPE)
+            AlignedReadsAsFasta = proc.communicate()[0]
+        assert proc.returncode == 0
+      except:
+        print('Problem calling mafft. Skipping to the next window.',
+        file=sys.stderr)
+        WindowOutput['FailedStage'] = 'alignment'
+        return
+      if MafftCache != None:
+        MafftCache.StoreData(MafftCacheKey, AlignedReadsAsFasta)
+    if not MergeReads:
+      with open(FileForReads, 'w') as f:
+        f.write(AlignedReadsAsFasta)
+
+  elif not FoundInCache:
+    with open(FileForReads, 'w') as f:
+      try:
+        with ExternalToolSlots:
+          ExitStatus = subprocess.call(MafftOptions + MafftInputFiles,
+          stdout=f)
+        assert ExitStatus == 0
+      except:
+        print('Problem calling mafft. Skipping to the next window.',
+        file=sys.stderr)
+        WindowOutput['FailedStage'] = 'alignment'
+        return
+      if not os.path.isfile(FileForReads):
+        print('Error:', FileForReads +', expected to be produced by mafft,',
+        'does not exist. Skipping to the next window.', file=sys.stderr)
+        WindowOutput['FailedStage'] = 'alignment'
+        return
+    if MafftCache != None:
+      MafftCache.Store(MafftCacheKey, FileForReads)
 
   if not MergeReads:
-    OutputFilesByDestinationDir['AlignedReads'].append(FileForAlnReadsHere)
+    OutputFilesHere['AlignedReads'].append(FileForAlnReadsHere)
 
   # Update on time taken if desired
   if args.time:
-    times.append(time.time())
-    LastStepTime = times[-1] - times[-2]
+    WindowTimes.append(time.time())
+    LastStepTime = WindowTimes[-1] - WindowTimes[-2]
     print('Read alignment in window', ThisWindowAsStr,
     'finished. Number of seconds taken: ', LastStepTime)
 
   # Read in the aligned reads.
   try:
-    SeqAlignmentHere = AlignIO.read(FileForReads, "fasta")
+    if args.stream_to_mafft:
+      SeqAlignmentHere = AlignIO.read(cStringIO.StringIO(AlignedReadsAsFasta),
+      "fasta")
+    else:
+      SeqAlignmentHere = AlignIO.read(FileForReads, "fasta")
   except:
     print('Malfunction of phyloscanner: problem encountered reading in',
     FileForReads, 'as an alignment. Quitting.', file=sys.stderr)
@@ -1939,17 +2515,18 @@ for window in range(NumCoords / 2):
       file=sys.stderr)
       raise
     AlignIO.write(SeqAlignmentHere, FileForAlnReadsHere, 'fasta')
-    OutputFilesByDestinationDir['AlignedReads'].append(FileForAlnReadsHere)
+    OutputFilesHere['AlignedReads'].append(FileForAlnReadsHere)
 
 
   # Find & write the consensuses.
   ConsensusAlignment = FindPatientsConsensuses(SeqAlignmentHere)
   FileForConsensuses = FileForConsensuses_basename + ThisWindowSuffix +'.fasta'
   AlignIO.write(ConsensusAlignment, FileForConsensuses, 'fasta')
-  OutputFilesByDestinationDir['Consensuses'].append(FileForConsensuses)
+  OutputFilesHere['Consensuses'].append(FileForConsensuses)
 
   # See if there are positions to excise in this window.
   if ExcisePositions:
+    StartWindowStage(WindowOutput, 'excision')
     FileForAlignedReads_PositionsExcised = \
     FileForAlignedReads_PositionsExcised_basename + ThisWindowSuffix +'.fasta'
     if PairwiseAlign:
@@ -1994,13 +2571,11 @@ for window in range(NumCoords / 2):
         RefInAlignment.replace(GapChar,''), '\nQuitting.', file=sys.stderr)
         exit(1)
 
-      # Excise the positions in the aligned set of reads.
+      # Excise the positions in the aligned set of reads, all in one go.
       PositionsInAlignment = \
       pf.TranslateSeqCoordsToAlnCoords(RefInAlignment, PositionsInUngappedRef)
-      assert PositionsInAlignment == sorted(PositionsInAlignment, reverse=True)
-      for pos in PositionsInAlignment:
-        SeqAlignmentHere = \
-        SeqAlignmentHere[:, :pos-1] + SeqAlignmentHere[:, pos:]
+      SeqAlignmentHere = pf.AlignmentWithoutPositions(SeqAlignmentHere,
+      PositionsInAlignment)
 
       # Excising positions may have made some sequences identical within a
       # sample, which need to be merged even if the merging parameter is 0.
@@ -2020,7 +2595,7 @@ for window in range(NumCoords / 2):
         raise
       AlignIO.write(SeqAlignmentHere, FileForAlignedReads_PositionsExcised,
       'fasta')
-      OutputFilesByDestinationDir['AlignedReads'].append(
+      OutputFilesHere['AlignedReads'].append(
       FileForAlignedReads_PositionsExcised)
       FileForTrees = FileForAlignedReads_PositionsExcised
 
@@ -2030,9 +2605,11 @@ for window in range(NumCoords / 2):
       FileForConsensuses_PositionsExcised_basename + ThisWindowSuffix +'.fasta'
       AlignIO.write(ConsensusAlignment, FileForConsensuses_PositionsExcised,
       'fasta')
-      OutputFilesByDestinationDir['Consensuses'].append(
+      OutputFilesHere['Consensuses'].append(
       FileForConsensuses_PositionsExcised)
 
+  StartWindowStage(WindowOutput, 'analysis')
+
   # If we're exploring window widths, we just care how many unique reads
   # were found here. Record & move on.
   if ExploreWindowWidths:
@@ -2043,9 +2620,9 @@ for window in range(NumCoords / 2):
         SampleName = seq.id[:RegexMatch.start()]
         NumUniqueReadsPerPatient[SampleName] += 1
     for alias, count in NumUniqueReadsPerPatient.items():
-      WindowWidthExplorationData.append([UserLeftWindowEdge,
+      ExplorationDataHere.append([UserLeftWindowEdge,
       UserRightWindowEdge, alias, count])
-    continue
+    return
 
   if CheckDuplicates:
 
@@ -2086,7 +2663,7 @@ for window in range(NumCoords / 2):
       with open(FileForDuplicateReadCountsProcessed, 'w') as f:
         f.write('\n'.join(','.join(SeqNames) for SeqNames in \
         DuplicatesDict.values()) + '\n')
-      OutputFilesByDestinationDir['DupData'].append(
+      OutputFilesHere['DupData'].append(
       FileForDuplicateReadCountsProcessed)
 
   # Output the correspondence between tip names and the names of the reads that
@@ -2112,12 +2689,12 @@ for window in range(NumCoords / 2):
             'to Chris Wymant. Quitting.', file=sys.stderr)
             exit(1)
           f.write(TipName + "," + ",".join(ReadNames) + "\n")
-    OutputFilesByDestinationDir['ReadNames'].append(FileForReadNames2)
+    OutputFilesHere['ReadNames'].append(FileForReadNames2)
 
   # Update on time taken if desired
   if args.time:
-    times.append(time.time())
-    LastStepTime = times[-1] - times[-2]
+    WindowTimes.append(time.time())
+    LastStepTime = WindowTimes[-1] - WindowTimes[-2]
     if args.check_recombination:
       print('All read processing except the recombination calculation in',
       'window', ThisWindowAsStr, 'finished. Number of seconds taken: ',
@@ -2158,17 +2735,22 @@ for window in range(NumCoords / 2):
         if not alias in SamplesToAlnPosDict:
           f.write('\n' + alias + ',NA,NA,NA,NA')
       f.write('\n')
-    OutputFilesByDestinationDir['RecombFiles'].append(FileForRecombinantReads)
+    OutputFilesHere['RecombFiles'].append(FileForRecombinantReads)
 
     # Update on time taken if desired
     if args.time:
-      times.append(time.time())
-      LastStepTime = times[-1] - times[-2]
+      WindowTimes.append(time.time())
+      LastStepTime = WindowTimes[-1] - WindowTimes[-2]
       print('Recombination calculation in window', ThisWindowAsStr,
       'finished. Number of seconds taken: ', LastStepTime)
 
+  # Record the file to make trees from, if there are enough seqs (at least 4)
+  # to make a tree, so that the trees can be remade if we resume.
+  if len(SeqAlignmentHere) >= 4:
+    WindowOutput['FileForTrees'] = FileForTrees
+
   if args.no_trees:
-    continue
+    return
 
   # Check that there are at least 4 seqs before calling RAxML.
   if len(SeqAlignmentHere) < 4:
@@ -2176,17 +2758,236 @@ for window in range(NumCoords / 2):
     ', contains only ', len(SeqAlignmentHere), ' sequences; at least 4 are ',
     'needed to make a tree. Skipping to the next window.', sep='',
     file=sys.stderr)
-    continue
+    return
 
   # Create the ML tree
-  if PrintInfo:
-    print('Running RAxML on the processed & aligned reads in window',
-    ThisWindowAsStr)
-    
-  NumMLtreesMade += pf.RunRAxML(FileForTrees, RAxMLargList, ThisWindowSuffix,
-  ThisWindowAsStr, UserLeftWindowEdge, UserRightWindowEdge, TempFiles,
-  TempFileForAllBootstrappedTrees_basename, args.bootstrap_seed,
-  args.num_bootstraps, times)
+  MakeTreesForWindow(WindowOutput, ThisWindowSuffix, ThisWindowAsStr,
+  UserLeftWindowEdge, UserRightWindowEdge, WindowTimes)
+
+def ProcessWindow(window, WindowOutput):
+  '''Processes one window completely (see ProcessWindowInStages).'''
+  for stage in ProcessWindowInStages(window, WindowOutput):
+    pass
+
+class WindowLogStream(object):
+  '''Stands in for stdout or stderr, storing what is written to it (in the
+  order it was written, together with the name of the stream it was intended
+  for) in a list shared with other such streams.'''
+  def __init__(self, StreamName, chunks):
+    self.StreamName = StreamName
+    self.chunks = chunks
+  def write(self, text):
+    self.chunks.append((self.StreamName, text))
+  def flush(self):
+    pass
+
+def ProcessWindowInWorker(window):
+  '''Calls ProcessWindow in a worker process, holding back what it prints.
+
+  Returns the WindowOutput dict (None if the window failed), everything printed
+  as a list of (stream name, text) pairs, and the exit status if the window
+  tried to quit (None otherwise).'''
+  WindowOutput = EmptyWindowOutput()
+  chunks = []
+  sys.stdout = WindowLogStream('stdout', chunks)
+  sys.stderr = WindowLogStream('stderr', chunks)
+  ExitStatus = None
+  try:
+    ProcessWindow(window, WindowOutput)
+  except SystemExit as err:
+    ExitStatus = err.code
+  except Exception:
+    print(traceback.format_exc(), end='', file=sys.stderr)
+    ExitStatus = 1
+  finally:
+    sys.stdout = sys.__stdout__
+    sys.stderr = sys.__stderr__
+  if ExitStatus != None:
+    WindowOutput = None
+  return WindowOutput, chunks, ExitStatus
+
+class ThreadLogStream(object):
+  '''Stands in for stdout or stderr while windows are processed by the
+  scheduler, storing what each thread writes in the list of chunks that thread
+  is currently using (ThreadLog.chunks) in the same way as WindowLogStream, or
+  passing it on to the real stream if that thread has no such list.'''
+  def __init__(self, StreamName, RealStream):
+    self.StreamName = StreamName
+    self.RealStream = RealStream
+  def write(self, text):
+    chunks = getattr(ThreadLog, 'chunks', None)
+    if chunks == None:
+      self.RealStream.write(text)
+    else:
+      chunks.append((self.StreamName, text))
+  def flush(self):
+    self.RealStream.flush()
+
+ThreadLog = threading.local()
+
+def RunWindowStage(stages, chunks):
+  '''Runs the next stage of a window being processed by the scheduler (see
+  ProcessWindowInStages), holding back what it prints in chunks.
+
+  Returns a pair of bools, True if the window has more stages to run and
+  True if the window tried to quit, followed by the exit status in the latter
+  case (None otherwise).'''
+  ThreadLog.chunks = chunks
+  try:
+    next(stages)
+  except StopIteration:
+    return False, None
+  except SystemExit as err:
+    return False, err.code
+  except Exception:
+    print(traceback.format_exc(), end='', file=sys.stderr)
+    return False, 1
+  finally:
+    ThreadLog.chunks = None
+  return True, None
+
+def FinishWindowInThread(stages, chunks):
+  '''Runs all remaining stages of a window in a scheduler thread. Returns the
+  exit status if the window tried to quit, None otherwise.'''
+  MoreStages = True
+  while MoreStages:
+    MoreStages, ExitStatus = RunWindowStage(stages, chunks)
+  return ExitStatus
+
+def ReportScheduledWindow(WindowOutput, chunks, ExitStatus, FinishResult):
+  '''Waits for a window being processed by the scheduler to finish, then
+  prints what it printed and records its output (or quits if it failed).'''
+  if FinishResult != None:
+    ExitStatus = FinishResult.get()
+  for StreamName, text in chunks:
+    getattr(sys, '__' + StreamName + '__').write(text)
+  sys.__stdout__.flush()
+  if ExitStatus != None:
+    sys.stdout = sys.__stdout__
+    sys.stderr = sys.__stderr__
+    exit(ExitStatus)
+  RecordWindowOutput(WindowOutput)
+
+# External programs wait for one of these slots to be free before running. By
+# default there is no rationing (windows are processed one at a time, or each
+# in its own process).
+ExternalToolSlots = pf.NoToolSlots()
+NumBootstrapSlots = args.parallel_bootstraps
+
+# Fingerprints of what the output of each window depends on, for the run
+# manifest: the input files (their names, sizes and modification times) and
+# the options used, except those that don't change the output of any window.
+# The options relating only to trees are fingerprinted separately, so that if
+# they alone change, only trees are remade when resuming.
+OptionsNotAffectingWindows = set(['quiet', 'verbose', 'time', 'processes',
+'external_jobs', 'parallel_bootstraps', 'read_bams_once', 'resume',
+'stream_to_mafft', 'mafft_cache', 'mafft_cache_size', 'keep_temp_files',
+'keep_output_together', 'output_dir'])
+OptionsForTreesOnly = set(['x_raxml', 'num_bootstraps', 'bootstrap_seed',
+'no_trees'])
+InputFiles = [args.BamAndRefList] + BamFiles + RefFiles
+for option, value in sorted(vars(args).items()):
+  if isinstance(value, basestring) and os.path.isfile(value) and \
+  not value in InputFiles:
+    InputFiles.append(value)
+InputsDescription = [[InputFile, os.path.getsize(InputFile),
+os.path.getmtime(InputFile)] for InputFile in InputFiles]
+ProcessingFingerprint = hashlib.md5(json.dumps([InputsDescription,
+sorted((option, value) for option, value in vars(args).items() if not \
+option in OptionsNotAffectingWindows and not option in OptionsForTreesOnly)],
+default=str)).hexdigest()
+if args.no_trees or ExploreWindowWidths:
+  TreesFingerprint = None
+else:
+  TreesFingerprint = hashlib.md5(json.dumps([ProcessingFingerprint,
+  RAxMLargList, sorted((option, value) for option, value in \
+  vars(args).items() if option in OptionsForTreesOnly)],
+  default=str)).hexdigest()
+
+# Read in the manifest of the run we're resuming, if there is one.
+ManifestWindows = {}
+ResumedManifestWindows = {}
+if args.resume:
+  try:
+    with open(FileForRunManifest, 'r') as f:
+      ResumedManifestWindows = json.load(f)['Windows']
+  except IOError:
+    print('Warning: --resume was specified but there is no', FileForRunManifest,
+    'file in the working directory; processing all windows.', file=sys.stderr)
+  except (ValueError, KeyError):
+    print('Warning: could not understand', FileForRunManifest + '; processing',
+    'all windows.', file=sys.stderr)
+  else:
+    if any(entry['Fingerprint'] != ProcessingFingerprint for entry in \
+    ResumedManifestWindows.values()):
+      print('Warning: some windows recorded in', FileForRunManifest, 'were',
+      'processed with different input files or options from those used now,',
+      'and will be processed again.', file=sys.stderr)
+    ManifestWindows.update(ResumedManifestWindows)
+
+# Iterate through the windows, either one after another, in a pool of worker
+# processes, or with the scheduler. In the latter two cases, what each window
+# prints is printed by the main process in window order.
+# The scheduler runs the first stage of each window (reading and pre-processing
+# the reads) in the main thread, one window after another, and the second stage
+# (aligning and making trees) in a pool of threads. External programs from all
+# windows share a fixed number of slots. Since the threads spend most of their
+# time waiting for external programs, the main thread can meanwhile pre-process
+# the next window. The number of windows pre-processed but not yet reported is
+# limited, to limit how many are held in memory at once.
+NumWindows = NumCoords / 2
+if args.read_bams_once:
+  ReadCollectorsByWindow = CollectReadsInAllWindows()
+  if args.time:
+    times.append(time.time())
+    LastStepTime = times[-1] - times[-2]
+    print('Reading all bam files for all windows finished. Number of seconds',
+    'taken:', LastStepTime)
+if args.external_jobs != None:
+  ExternalToolSlots = threading.BoundedSemaphore(args.external_jobs)
+  NumBootstrapSlots = max(args.parallel_bootstraps, args.external_jobs)
+  MaxWindowsInFlight = 2 * args.external_jobs
+  sys.stdout = ThreadLogStream('stdout', sys.__stdout__)
+  sys.stderr = ThreadLogStream('stderr', sys.__stderr__)
+  pool = ThreadPool(min(args.external_jobs, NumWindows))
+  WindowsInFlight = collections.deque()
+  for window in range(NumWindows):
+    WindowOutput = EmptyWindowOutput()
+    chunks = []
+    stages = ProcessWindowInStages(window, WindowOutput)
+    MoreStages, ExitStatus = RunWindowStage(stages, chunks)
+    if MoreStages:
+      FinishResult = pool.apply_async(FinishWindowInThread, (stages, chunks))
+    else:
+      FinishResult = None
+    WindowsInFlight.append((WindowOutput, chunks, ExitStatus, FinishResult))
+    while WindowsInFlight and (len(WindowsInFlight) > MaxWindowsInFlight or \
+    WindowsInFlight[0][3] == None or WindowsInFlight[0][3].ready()):
+      ReportScheduledWindow(*WindowsInFlight.popleft())
+  while WindowsInFlight:
+    ReportScheduledWindow(*WindowsInFlight.popleft())
+  pool.close()
+  pool.join()
+  sys.stdout = sys.__stdout__
+  sys.stderr = sys.__stderr__
+elif args.processes == 1:
+  for window in range(NumWindows):
+    WindowOutput = EmptyWindowOutput()
+    ProcessWindow(window, WindowOutput)
+    RecordWindowOutput(WindowOutput)
+else:
+  pool = multiprocessing.Pool(min(args.processes, NumWindows))
+  for WindowOutput, chunks, ExitStatus in \
+  pool.imap(ProcessWindowInWorker, range(NumWindows)):
+    for StreamName, text in chunks:
+      getattr(sys, StreamName).write(text)
+    sys.stdout.flush()
+    if ExitStatus != None:
+      pool.terminate()
+      exit(ExitStatus)
+    RecordWindowOutput(WindowOutput)
+  pool.close()
+  pool.join()
 
 if ExploreWindowWidths:
   TableHeaders = 'Window start,' + ','.join(sorted(BamAliases))
@@ -2221,6 +3022,7 @@ if ExploreWindowWidths:
       ','.join(map(str,ReadCountsSortedByBam))
   with open(args.explore_window_width_file, 'w') as f:  
     f.write(OutputTables)
+  CloseBamFiles()
   CleanUp(TempFiles)
   if PrintInfo:
     print("All windows explored; data in", args.explore_window_width_file + \
@@ -2251,12 +3053,14 @@ if args.inspect_disagreeing_overlaps:
       else:
         OutputFilesByDestinationDir['DiscardedReads'].append(LocalRefFileName)
       OutFile = FileForDiscardedReadPairs_basename +BamFileBasename
-      DiscardedReadPairsOut = pysam.AlignmentFile(OutFile, "wb", template=BamFile)
+      DiscardedReadPairsOut = pysam.AlignmentFile(OutFile, "wb",
+      template=GetBamFile(BamFiles[WhichBamFile]))
       for read in DiscardedReadPairs:
         DiscardedReadPairsOut.write(read)
       DiscardedReadPairsOut.close()
       OutputFilesByDestinationDir['DiscardedReads'].append(OutFile)
 
+CloseBamFiles()
 
 OutputFilesByDestinationDir['raxml'] = glob.glob('RAxML_*')
 
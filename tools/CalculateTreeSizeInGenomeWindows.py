@@ -17,8 +17,11 @@ though its --normRefFileName option.'''
 import argparse
 import os
 import sys
+import shutil
 import subprocess
+import tempfile
 from Bio import AlignIO
+from Bio import Phylo
 import phyloscanner_funcs as pf
 
 # Define a function to check files exist, as a type for the argparse.
@@ -57,11 +60,12 @@ of the window width (so that, except for close to the edges of the genome,
 each position is spanned by ten different windows). A smaller increment will be
 used just for the final window if necessary for it to finish exactly at the
 desired end point.''')
-parser.add_argument('-T', '--threads', type=int, help='''Number of threads to
-use. See the phyloscanner manual chapter 'Branch length normalisation' for an
-explanation of an alternative way of parallelising this script that is suitable
-for massive parallelisation (as opposed to just using multiple cores on a single
-machine, which this option does).''')
+parser.add_argument('-T', '--threads', type=int, help='''Number of windows to
+process at the same time, each in its own process (and its own temporary
+directory). See the phyloscanner manual chapter 'Branch length normalisation'
+for an explanation of an alternative way of parallelising this script that is
+suitable for massive parallelisation (as opposed to just using multiple cores on
+a single machine, which this option does).''')
 RAxMLdefaultOptions = "-m GTRCAT -p 1 --no-seq-check"
 RaxmlHelp ='''Use this option to specify how RAxML is to be run, including
 both the executable (with the path to it if needed), and the options. If you do
@@ -99,21 +103,22 @@ if os.path.isfile(OutFileByPosition):
   exit(1)
 
 # Check the code
-TreeSizeCode = pf.FindAndCheckCode('CalculateMedianPatristicDistance.R')
-ToPerPositionCode = \
-pf.FindAndCheckCode('FromPerWindowStatsToPerPositionStats.py')
+PythonPath = sys.executable
+ToPerPositionCode = pf.FindAndCheckCode(PythonPath,
+'FromPerWindowStatsToPerPositionStats.py')
 
-# Set up multithreading if needed
+# Set up multiprocessing if needed
 multithread = args.threads != None
 if multithread:
   if args.threads == 1:
     multithread = False
   else:
     try:
-      from multiprocessing.dummy import Pool
+      from multiprocessing import Pool
     except ImportError:
-      print('Problem importing Pool from the multiprocessing.dummy module. This',
-      'is required for multithreading. Quitting.', file=sys.stderr)
+      print('Problem importing Pool from the multiprocessing module. This',
+      'is required for processing windows in parallel. Quitting.',
+      file=sys.stderr)
       exit(1)
     if args.threads < 2:
       print('The number of threads must be positive. Quitting.',
@@ -122,6 +127,15 @@ if multithread:
 
 # Test RAxML works
 RAxMLargList = pf.TestRAxML(args.x_raxml, RAxMLdefaultOptions, RaxmlHelp)
+
+# RAxML is run from a temporary directory for each window, so make a relative
+# path to the RAxML executable, or to a directory given with its -w option,
+# absolute.
+if os.sep in RAxMLargList[0]:
+  RAxMLargList[0] = os.path.abspath(RAxMLargList[0])
+for i in range(1, len(RAxMLargList) - 1):
+  if RAxMLargList[i] == '-w':
+    RAxMLargList[i + 1] = os.path.abspath(RAxMLargList[i + 1])
     
 # Extract the chosen seq
 try:
@@ -223,8 +237,15 @@ for i in range(NumWindows):
 # Keep track of temp files to delete them at the end
 TempFilesSet = set([])
 
+StartingDir = os.getcwd()
+
 def GetTreeSizeFromWindow(WindowNumber):
-  '''Extracts a window from an alignement, runs RAxML, finds the tree size.'''
+  '''Extracts a window from an alignement, runs RAxML, finds the tree size.
+
+  The work is done in a temporary directory for this window, from which the
+  alignment and RAxML files are moved to the working directory afterwards. This
+  function is run in a separate process for each window if desired, so rather
+  than exiting if there's a problem, it returns None.'''
 
   # Get the start and end. Zero-based indexing for the alignment.
   ChosenSeqStart = WindowStarts[WindowNumber]
@@ -240,7 +261,25 @@ def GetTreeSizeFromWindow(WindowNumber):
   str(ChosenSeqEnd)
   WindowAsStr = str(ChosenSeqStart) + '-' + str(ChosenSeqEnd)
 
-  SeqAlignmentHere = alignment[:, start:end+1]
+  ScratchDir = tempfile.mkdtemp(prefix='temp_' + WindowSuffix + '_',
+  dir=StartingDir)
+  os.chdir(ScratchDir)
+  try:
+    TreeSize = MakeTreeAndFindSize(alignment[:, start:end+1], WindowSuffix,
+    WindowAsStr, ChosenSeqStart, ChosenSeqEnd)
+  finally:
+    os.chdir(StartingDir)
+    for FileName in os.listdir(ScratchDir):
+      shutil.move(os.path.join(ScratchDir, FileName),
+      os.path.join(StartingDir, FileName))
+    shutil.rmtree(ScratchDir)
+  return TreeSize
+
+def MakeTreeAndFindSize(SeqAlignmentHere, WindowSuffix, WindowAsStr,
+ChosenSeqStart, ChosenSeqEnd):
+  '''Runs RAxML on the alignment in the working directory and returns the
+  median patristic distance in the tree (or None if there's a problem).'''
+
   FileForAlnHere = FileForAlignment_basename + WindowSuffix + '.fasta'
   AlignIO.write(SeqAlignmentHere, FileForAlnHere, 'fasta')
 
@@ -249,36 +288,38 @@ def GetTreeSizeFromWindow(WindowNumber):
   TempFileForAllBootstrappedTrees_basename)
 
   if NumTreesMade != 1:
-    print('Problem running RAxML in window', str(ChosenSeqStart) + '-' + \
-    str(ChosenSeqEnd) + '. Quitting', file=sys.stderr)
-    exit(1)
+    print('Problem running RAxML in window', WindowAsStr + '.',
+    file=sys.stderr)
+    return None
 
   MLtreeFile = 'RAxML_bestTree.' + WindowSuffix + '.tree'
   if not os.path.isfile(MLtreeFile):
     print('Error: we lost the tree file produced by RAxML -', MLtreeFile + \
-    '. Please report this to Chris Wymant. Quitting', file=sys.stderr)
-    exit(1)
+    '. Please report this to Chris Wymant.', file=sys.stderr)
+    return None
 
-  proc = subprocess.Popen([TreeSizeCode, MLtreeFile], stdout=subprocess.PIPE,
-  stderr=subprocess.PIPE)
-  out, err = proc.communicate()
-  TreeSizeCodeExitStatus = proc.returncode
   try:
-    assert TreeSizeCodeExitStatus == 0
-    TreeSize = float(out)
-  except (AssertionError, ValueError):
-    print('Problem calculating the size of the tree', MLtreeFile, 'using',
-    TreeSizeCode + ':', err + '\nQuitting.', file=sys.stderr)
-    raise
+    tree = Phylo.read(MLtreeFile, 'newick')
+  except Exception as err:
+    print('Problem reading the tree', MLtreeFile + ':', err, file=sys.stderr)
+    return None
 
-  return TreeSize
+  # Previously the tree size was found by CalculateMedianPatristicDistance.R,
+  # which printed it to 7 significant figures; we round it likewise, so that
+  # results are unchanged.
+  return float('%.7g' % pf.MedianPatristicDistance(tree))
 
 # Process all windows
 if multithread:
   pool = Pool(args.threads)
   TreeSizes = pool.map(GetTreeSizeFromWindow, range(NumWindows))
+  pool.close()
+  pool.join()
 else:
   TreeSizes = [GetTreeSizeFromWindow(i) for i in range(NumWindows)]
+if None in TreeSizes:
+  print('Quitting.', file=sys.stderr)
+  exit(1)
 
 # Write the output file with tree sizes by window
 with open(OutFileByWindow, 'w') as f:
@@ -288,8 +329,8 @@ with open(OutFileByWindow, 'w') as f:
     str(WindowEnds[WindowNumber]) + ',' + str(TreeSizes[WindowNumber]) + '\n')
 
 with open(OutFileByPosition, 'w') as f:
-  proc = subprocess.Popen([ToPerPositionCode, OutFileByWindow], stdout=f,
-  stderr=subprocess.PIPE)
+  proc = subprocess.Popen([PythonPath, ToPerPositionCode, OutFileByWindow],
+  stdout=f, stderr=subprocess.PIPE)
   out, err = proc.communicate()
   ExitStatus = proc.returncode
   if ExitStatus != 0:
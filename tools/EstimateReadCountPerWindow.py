@@ -17,6 +17,9 @@ function of W.'''
 
 import os
 import sys
+import math
+import zlib
+import heapq
 import argparse
 import pysam
 import phyloscanner_funcs as pf
@@ -86,6 +89,15 @@ parser.add_argument('-XM', '--x-min-max', help='The minimum and maximum for '\
 parser.add_argument('-YM', '--y-min-max', help='The minimum and maximum for '\
 'the y axis in the plot, specified together as a comma-separated pair of '\
 'numbers.')
+parser.add_argument('-SS', '--subsample', type=float, help='''Used to
+specify a fraction between 0 and 1: only this fraction of the reads in each bam
+file, chosen at random (with the two reads in a pair chosen together), is used,
+and counts are scaled up accordingly. This is faster for large bam files, at the
+cost of the counts being estimates. For an estimated count C of unpaired reads,
+the relative standard error is about sqrt((1 - fraction) / (fraction * C)),
+larger by up to a factor of sqrt(2) for paired reads; we print this for the
+total number of reads in each bam. (With --overlapping-insert-sizes, the
+estimated counts are written to one decimal place.)''')
 parser.add_argument('--x-samtools', default='samtools', help=\
 'Used to specify the command required to run samtools, if it is needed to index'
 ' the bam files (by default: samtools).')
@@ -93,6 +105,16 @@ args = parser.parse_args()
 
 InsertSizesOnly = args.overlapping_insert_sizes
 
+Subsample = args.subsample != None
+if Subsample:
+  if not 0 < args.subsample <= 1:
+    print('The --subsample option requires a number greater than 0 and no',
+    'greater than 1. Quitting.', file=sys.stderr)
+    exit(1)
+  # A read is used if its name hashes to below this value, so that both reads
+  # in a pair are used or neither is.
+  SubsampleHashThreshold = args.subsample * 2**32
+
 def GetIntPair(arg, ArgName):
   MinMax = arg.split(',')
   if len(MinMax) != 2:
@@ -130,26 +152,32 @@ def FindReadCountAsFuncOfWindowWidth(ReadSizeCountDict, RefLength):
     return np.zeros(0)
 
   LargestReadLength = max(ReadSizeCountDict.keys())
-  RefLengthPlus1 = RefLength + 1
-
-  # The nth element of this list will eventually contain the number of reads
-  # expected to span a window of width n+1 (list is zero-based).
-  ReadsCountByWindowWidth = np.zeros(LargestReadLength)
-
-  for ReadLength, count in ReadSizeCountDict.items():
 
-    ReadLengthPlus1 = ReadLength + 1
-
-    # The number of positions at which we could place a window of width W is
-    # RefLength - W + 1
-    # The number of positions at which we could place a window of width W such
-    # that it is wholly inside a read is ReadLength - W + 1
-    # Probability of a given read overlapping a window of width W is therefore
-    # (ReadLength - W + 1) / (RefLength - W + 1) 
-    for W in range(1, ReadLengthPlus1):
-      NumSpanningReads = count * \
-      float(ReadLengthPlus1 - W) / (RefLengthPlus1 - W)
-      ReadsCountByWindowWidth[W-1] += NumSpanningReads
+  # The number of positions at which we could place a window of width W is
+  # RefLength - W + 1
+  # The number of positions at which we could place a window of width W such
+  # that it is wholly inside a read is ReadLength - W + 1
+  # Probability of a given read overlapping a window of width W is therefore
+  # (ReadLength - W + 1) / (RefLength - W + 1)
+  # Summing over all reads at least W long, the expected number spanning the
+  # window is
+  # (TotalLength(W) - (W - 1) * TotalCount(W)) / (RefLength - W + 1)
+  # where TotalCount(W) is the number of such reads and TotalLength(W) the sum
+  # of their lengths. We find these for every W at once from cumulative sums,
+  # running from the longest read length down.
+  ReadLengths = np.array(ReadSizeCountDict.keys())
+  ReadLengthHist = np.bincount(ReadLengths,
+  weights=np.array(ReadSizeCountDict.values(), dtype=float),
+  minlength=LargestReadLength + 1)
+  TotalCount = np.cumsum(ReadLengthHist[::-1])[::-1]
+  TotalLength = np.cumsum((ReadLengthHist * \
+  np.arange(LargestReadLength + 1))[::-1])[::-1]
+
+  # The nth element of this array contains the number of reads expected to span
+  # a window of width n+1 (array is zero-based).
+  W = np.arange(1, LargestReadLength + 1)
+  ReadsCountByWindowWidth = (TotalLength[1:] - (W - 1) * TotalCount[1:]) / \
+  (RefLength + 1 - W)
 
   if args.normalise:
     ReadsCountByWindowWidth = [float(count) / ReadsCountByWindowWidth[0] \
@@ -184,39 +212,66 @@ for i, BamFileName in enumerate(BamFiles):
     exit(1)
   RefLength = AllRefLengths[0]
 
-  PairedReadCoords = {}
   ReadLengthCounts = {}
   InsertSizeCounts = {}
   TotalReadCount = 0
+  NumMissingMates = 0
+  NumMatedPairs = 0
+
+  # Paired reads whose mate we have not yet encountered, keyed by name, with
+  # the start position of the mate. Since fetching requires the bam to be sorted
+  # by position, once we pass the mate's start position without encountering it
+  # it is missing, so we only need to keep reads whose mate is still ahead of
+  # us. MateStartsAwaited is a heap of those mate start positions.
+  ReadsAwaitingMates = {}
+  MateStartsAwaited = []
 
   # Iterate through the reads
   for read in bam.fetch(RefName):
 
-    MappedPositions = read.get_reference_positions(full_length=False)
-
     # Skip unmapped reads
-    if not MappedPositions:
+    if read.is_unmapped or read.reference_end == None:
+      continue
+
+    if Subsample and \
+    (zlib.crc32(read.query_name) & 0xffffffff) >= SubsampleHashThreshold:
       continue
 
     TotalReadCount += 1
 
-    start = min(MappedPositions[0], MappedPositions[-1])
-    end   = max(MappedPositions[0], MappedPositions[-1])
+    # The first and last reference positions to which the read is aligned.
+    start = read.reference_start
+    end   = read.reference_end - 1
     ReadLength = end - start
     try:
       ReadLengthCounts[ReadLength] += 1
     except KeyError:
       ReadLengthCounts[ReadLength] = 1
-      
+
+    # For paired reads whose mate we've now passed without finding it, add just
+    # the read length to the insert size distribution.
+    while MateStartsAwaited and MateStartsAwaited[0][0] < start:
+      MateStart, ReadName = heapq.heappop(MateStartsAwaited)
+      if ReadName in ReadsAwaitingMates and \
+      ReadsAwaitingMates[ReadName][2] == MateStart:
+        MissingMateStart, MissingMateEnd, MateStart = \
+        ReadsAwaitingMates.pop(ReadName)
+        NumMissingMates += 1
+        MissingMateLength = MissingMateEnd - MissingMateStart
+        try:
+          InsertSizeCounts[MissingMateLength] += 1
+        except KeyError:
+          InsertSizeCounts[MissingMateLength] = 1
+
     # The first time we encounter a mate from a pair, record its start and end.
     # When we encounter its mate, if they overlap, record the insert size; if
     # they don't overlap, record their separate lengths as though they are two
     # different inserts (because phyloscanner won't merge them - they are
     # effectively two separate inserts from the point of view of merging).
     if read.is_paired:
-      if read.query_name in PairedReadCoords:
-        MateStart, MateEnd, MateFoundBool = PairedReadCoords[read.query_name]
-        PairedReadCoords[read.query_name][2] = True
+      if read.query_name in ReadsAwaitingMates:
+        MateStart, MateEnd, _ = ReadsAwaitingMates.pop(read.query_name)
+        NumMatedPairs += 1
         if start <= MateStart <= end:
           InsertSize = max(end, MateEnd) - start
           try:
@@ -239,24 +294,47 @@ for i, BamFileName in enumerate(BamFiles):
             InsertSizeCounts[MateLength] += 1
           except KeyError:
             InsertSizeCounts[MateLength] = 1
+      elif read.mate_is_unmapped or read.next_reference_id != \
+      read.reference_id or read.next_reference_start < start:
+        # The mate is not mapped here, or should already have been encountered.
+        NumMissingMates += 1
+        try:
+          InsertSizeCounts[ReadLength] += 1
+        except KeyError:
+          InsertSizeCounts[ReadLength] = 1
       else:
-        PairedReadCoords[read.query_name] = [start, end, False]
+        ReadsAwaitingMates[read.query_name] = \
+        (start, end, read.next_reference_start)
+        heapq.heappush(MateStartsAwaited,
+        (read.next_reference_start, read.query_name))
 
   # For paired reads for which we didn't find a mate, add just the read length
   # to the insert size distribution.
-  NumMissingMates = 0
-  for start, end, MateFound in PairedReadCoords.values():
-    if not MateFound:
-      NumMissingMates += 1
-      ReadLength = end - start
-      try: 
-        InsertSizeCounts[ReadLength] += 1
-      except KeyError:
-        InsertSizeCounts[ReadLength] = 1
+  for start, end, MateStart in ReadsAwaitingMates.values():
+    NumMissingMates += 1
+    ReadLength = end - start
+    try: 
+      InsertSizeCounts[ReadLength] += 1
+    except KeyError:
+      InsertSizeCounts[ReadLength] = 1
   if NumMissingMates > 0:
     print('Info:', NumMissingMates, 'of', TotalReadCount, 'reads in',
     BamFileName, "are flagged as being paired but don't have a mate present.")
 
+  # If subsampling, scale the counts up to estimate those for all reads, and
+  # report how precise the estimate of the total is. Reads are chosen by name,
+  # so a pair of reads is chosen or not as a unit, which the error accounts for.
+  if Subsample and TotalReadCount > 0:
+    for counts in (ReadLengthCounts, InsertSizeCounts):
+      for size in counts:
+        counts[size] /= args.subsample
+    if args.subsample < 1:
+      RelativeError = math.sqrt((1 - args.subsample) * \
+      (TotalReadCount + 2 * NumMatedPairs)) / TotalReadCount
+      print('Info: using', TotalReadCount, 'of', bam.mapped, 'mapped reads in',
+      BamFileName + '; the relative standard error of the estimated total',
+      'read count is about', '%.2g%%.' % (100 * RelativeError))
+
   # Skip empty bams
   if TotalReadCount == 0:
     print('Warning: no reads found in', BamFileName + '. Skipping.')
@@ -276,6 +354,8 @@ if InsertSizesOnly:
     'non-overlapping pair,Count\n')
     for alias, InsertSizesOnly in InsertSizesOnlyByBam.items():
       for size, count in sorted(InsertSizesOnly.items(), key=lambda x:x[0]):
+        if Subsample:
+          count = '%.1f' % count
         f.write(alias + ',' + str(size) + ',' + str(count) + '\n')
   exit(0)  
 
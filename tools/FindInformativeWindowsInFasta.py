@@ -20,6 +20,8 @@ import os
 import sys
 from Bio import AlignIO
 import collections
+import numpy as np
+import phyloscanner_funcs as pf
 
 # Define a function to check files exist, as a type for the argparse.
 def File(MyFile):
@@ -81,18 +83,36 @@ if args.end_position != None:
 else:
   EndPos = NumCols
 
+# Count the gaps in each column once, and the cumulative sum of non-gap
+# characters: CumNonGapCounts[n] is the total over the first n columns. A
+# window's weight is the difference between two elements of this, divided by the
+# number of seqs.
+GapCounts = (pf.AlignmentAsMatrix(alignment) == ord('-')).sum(axis=0)
+CumNonGapCounts = np.concatenate(([0], np.cumsum(NumSeqs - GapCounts)))
+
 def FindWindowEnd(StartPos):
   '''Finds the end of the window, weighting columns by their non-gap fraction.
   Uses zero-based positions.'''
-  CurrentWindowWeight = 0
-  for position in range(StartPos,EndPos):
-    if position == EndPos-1:
-      return position
-    column = alignment[:, position]
-    NonGapFrac = 1 - float(column.count('-'))/NumSeqs
-    CurrentWindowWeight += NonGapFrac
-    if CurrentWindowWeight >= args.WeightedWindowWidth:
-      return position
+  # Find the first position at which the window's weight reaches the desired
+  # width, by binary search. The window can't go past EndPos.
+  TargetCount = CumNonGapCounts[StartPos] + args.WeightedWindowWidth * NumSeqs
+  NumCols = np.searchsorted(CumNonGapCounts, TargetCount)
+  WindowEnd = NumCols - 1
+
+  # If the weight is exactly the desired width there, summing the non-gap
+  # fractions as floats (as we always have) may fall just short of it, in which
+  # case the window continues up to the next column with any bases. Check by
+  # summing them exactly as before, up to that column.
+  if NumCols < len(CumNonGapCounts) and \
+  CumNonGapCounts[NumCols] == TargetCount:
+    NextNumCols = np.searchsorted(CumNonGapCounts, TargetCount, side='right')
+    WindowWeights = np.cumsum(1 - GapCounts[StartPos:NextNumCols] / \
+    float(NumSeqs))
+    WindowEnd = StartPos + np.argmax(WindowWeights >= args.WeightedWindowWidth)
+    if WindowWeights[-1] < args.WeightedWindowWidth:
+      WindowEnd = EndPos - 1
+
+  return min(WindowEnd, EndPos - 1)
 
 # Iteratively find windows. We stop when either the right- or left-hand edge of
 # the window reaches the end (the latter being possible with negative overlap).
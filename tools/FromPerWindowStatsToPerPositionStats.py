@@ -13,9 +13,9 @@ overlapping a particular position. Output is printed to stdout, suitable for
 redirection to a new csv file.'''
 
 import os
-import copy
 import sys
 import argparse
+import numpy as np
 
 # Define a function to check files exist, as a type for the argparse.
 def File(MyFile):
@@ -28,8 +28,9 @@ parser = argparse.ArgumentParser(description=ExplanatoryMessage)
 parser.add_argument('CsvFile', type=File)
 args = parser.parse_args()
 
-StatTotalsByPosition = {}
-StatCountsByPosition = {}
+WindowStarts = []
+WindowEnds = []
+WindowStats = []
 
 with open(args.CsvFile) as f:
   for LineNumMin1, line in enumerate(f):
@@ -71,25 +72,41 @@ with open(args.CsvFile) as f:
       file=sys.stderr)
       exit(1)
 
-    for pos in range(WindowStart, WindowEnd+1):
-      if pos in StatTotalsByPosition:
-        for i in range(NumStats):
-          StatTotalsByPosition[pos][i] += stats[i]
-        StatCountsByPosition[pos] += 1
-      else:
-        StatTotalsByPosition[pos] = copy.deepcopy(stats)
-        StatCountsByPosition[pos] = 1
+    WindowStarts.append(WindowStart)
+    WindowEnds.append(WindowEnd)
+    WindowStats.append(stats)
 
 # Check we have data
-if not StatTotalsByPosition:
+if not WindowStarts:
   print('Found no data in', args.CsvFile + '. Quitting.', file=sys.stderr)
   exit(1)
 
-# Print the output
-print(header.rstrip())
-for position, StatsTotals in sorted(StatTotalsByPosition.items(),
-key=lambda x: x[0]):
-  count = StatCountsByPosition[position]
-  MeanStats = [float(stat) / count for stat in StatsTotals]
-  print(position, ','.join(map(str,MeanStats)), sep=',')
+# Sum the stats at each position. The window starts and ends split the
+# positions into segments, each overlapped by the same windows at all of its
+# positions, so the sums need only be found once per segment. Each window's
+# values are added in turn, in the order of the file, so that the sums are
+# rounded exactly as they would be if found one position at a time. Starting
+# from -0.0 keeps the first value added exactly, including the sign of zero.
+# (numpy's in-place addition can lose the sign of a zero sum, so we don't use it.)
+WindowStarts = np.array(WindowStarts)
+WindowEnds = np.array(WindowEnds)
+SegmentStarts = np.unique(np.concatenate((WindowStarts, WindowEnds + 1)))
+NumSegments = len(SegmentStarts) - 1
+WindowStartSegments = np.searchsorted(SegmentStarts, WindowStarts)
+WindowAfterEndSegments = np.searchsorted(SegmentStarts, WindowEnds + 1)
+StatCountsBySegment = np.zeros(NumSegments, dtype=int)
+StatTotalsBySegment = np.full((NumSegments, NumStats), -0.0)
+for StartSegment, AfterEndSegment, stats in zip(WindowStartSegments,
+WindowAfterEndSegments, WindowStats):
+  StatTotalsBySegment[StartSegment:AfterEndSegment] = \
+  StatTotalsBySegment[StartSegment:AfterEndSegment] + stats
+  StatCountsBySegment[StartSegment:AfterEndSegment] += 1
 
+# Print the output, for positions overlapped by at least one window.
+print(header.rstrip())
+for segment in np.flatnonzero(StatCountsBySegment):
+  count = StatCountsBySegment[segment]
+  MeanStats = ','.join(map(str,
+  (StatTotalsBySegment[segment] / float(count)).tolist()))
+  for position in xrange(SegmentStarts[segment], SegmentStarts[segment + 1]):
+    print(position, MeanStats, sep=',')
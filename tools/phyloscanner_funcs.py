@@ -2,9 +2,20 @@ from __future__ import print_function
 import os
 import sys
 import subprocess
-import itertools
+import shutil
+import tempfile
+import hashlib
+import json
+import threading
 import csv
+import collections
 import time
+import bisect
+import numpy as np
+from multiprocessing.dummy import Pool as ThreadPool
+from Bio.Align import MultipleSeqAlignment
+from Bio.SeqRecord import SeqRecord
+from Bio.Seq import Seq
 
 GapChar = '-'
 
@@ -155,6 +166,119 @@ def ReadInputCSVfile(TheFile):
   return BamFiles, RefFiles, aliases, BamBaseNames
 
 
+def FileChecksum(FileName):
+  '''Returns the md5 checksum of a file, or None if it can't be read.'''
+  checksum = hashlib.md5()
+  try:
+    with open(FileName, 'rb') as f:
+      for block in iter(lambda: f.read(1048576), b''):
+        checksum.update(block)
+  except IOError:
+    return None
+  return checksum.hexdigest()
+
+class AlignmentCache(object):
+  '''An on-disk cache of the files made by an aligner, each stored under a hash
+  of the command used to make it and of the contents of the files it aligned.
+
+  The cache directory may be shared between runs, and between the processes or
+  threads of one run. When the total size of the cached files exceeds MaxBytes,
+  those least recently used are deleted.'''
+
+  def __init__(self, CacheDir, MaxBytes):
+    self.CacheDir = CacheDir
+    self.MaxBytes = MaxBytes
+    self.lock = threading.Lock()
+    if not os.path.isdir(CacheDir):
+      os.makedirs(CacheDir)
+
+  def Key(self, ArgList, InputFiles):
+    '''Returns the key for aligning the given files with the given arguments
+    (which should not include the file names, only the options).'''
+    return self.KeyFromChecksums(ArgList, [FileChecksum(InputFile) for \
+    InputFile in InputFiles])
+
+  def KeyFromChecksums(self, ArgList, InputChecksums):
+    '''Like Key, but given the md5 checksums of the input files' contents
+    instead of the files, e.g. for input that is never written to a file.'''
+    return hashlib.md5(json.dumps([ArgList] + InputChecksums)).hexdigest()
+
+  def Fetch(self, key, OutputFile):
+    '''Copies the file cached under the key to OutputFile, returning True if
+    there is one and False if not.'''
+    CachedFile = os.path.join(self.CacheDir, key)
+    try:
+      shutil.copyfile(CachedFile, OutputFile)
+      # Using a file counts as its modification, for deciding what to evict.
+      os.utime(CachedFile, None)
+    except (IOError, OSError):
+      return False
+    return True
+
+  def FetchData(self, key):
+    '''Returns the contents of the file cached under the key, or None if there
+    is no such file.'''
+    CachedFile = os.path.join(self.CacheDir, key)
+    try:
+      with open(CachedFile, 'rb') as f:
+        data = f.read()
+      os.utime(CachedFile, None)
+    except (IOError, OSError):
+      return None
+    return data
+
+  def Store(self, key, OutputFile):
+    '''Adds a copy of OutputFile to the cache under the key, then evicts the
+    least recently used files if the cache is too big. Failing to add it is
+    not an error: it's just not cached.'''
+    CachedFile = os.path.join(self.CacheDir, key)
+    # Copy to a temporary name then rename, so no-one can fetch a partial copy.
+    TempCachedFile = CachedFile + '.' + str(os.getpid()) + '_' + \
+    threading.current_thread().name + '.tmp'
+    try:
+      shutil.copyfile(OutputFile, TempCachedFile)
+      os.rename(TempCachedFile, CachedFile)
+    except (IOError, OSError):
+      return
+    self.Evict()
+
+  def StoreData(self, key, data):
+    '''Like Store, but given the contents of the output instead of a file.'''
+    CachedFile = os.path.join(self.CacheDir, key)
+    TempCachedFile = CachedFile + '.' + str(os.getpid()) + '_' + \
+    threading.current_thread().name + '.tmp'
+    try:
+      with open(TempCachedFile, 'wb') as f:
+        f.write(data)
+      os.rename(TempCachedFile, CachedFile)
+    except (IOError, OSError):
+      return
+    self.Evict()
+
+  def Evict(self):
+    '''Deletes cached files, least recently used first, until their total
+    size is no more than MaxBytes.'''
+    with self.lock:
+      CachedFiles = []
+      for FileName in os.listdir(self.CacheDir):
+        if FileName.endswith('.tmp'):
+          continue
+        CachedFile = os.path.join(self.CacheDir, FileName)
+        try:
+          FileStats = os.stat(CachedFile)
+        except OSError:
+          continue
+        CachedFiles.append((FileStats.st_mtime, FileStats.st_size, CachedFile))
+      TotalBytes = sum(size for LastUsed, size, CachedFile in CachedFiles)
+      for LastUsed, size, CachedFile in sorted(CachedFiles):
+        if TotalBytes <= self.MaxBytes:
+          break
+        try:
+          os.remove(CachedFile)
+        except OSError:
+          pass
+        TotalBytes -= size
+
 def TestRAxML(ArgString, DefaultFlags, HelpMessage):
   '''Runs RAxML with the desired options and --flag-check.'''
 
@@ -224,23 +348,87 @@ def TestRAxML(ArgString, DefaultFlags, HelpMessage):
 
   return ArgList
 
+class NoToolSlots(object):
+  '''Stands in for a semaphore rationing how many external programs may run at
+  once, when there is no such rationing.'''
+  def __enter__(self):
+    return self
+  def __exit__(self, ExceptionType, ExceptionValue, traceback):
+    return False
+
+def RunBootstrapReplicate(RAxMLargList, BootstrappedAlignment, RunName,
+WorkingDirPrefix, ToolSlots):
+  '''Runs RAxML on one bootstrapped alignment inside its own working directory.
+
+  Each replicate gets a new directory of its own (in the current directory, its
+  name starting with WorkingDirPrefix) so that replicates running at the same
+  time can never write to (or be refused because of) each other's output files.
+  Afterwards the output files are moved back into the current directory, where
+  they would have been made had the replicate been run there, and the working
+  directory is removed. Returns None on success or a string describing
+  the problem on failure. RAxML is run only once one of the ToolSlots is
+  free.'''
+
+  try:
+    WorkingDir = os.path.abspath(tempfile.mkdtemp(prefix=WorkingDirPrefix,
+    dir='.'))
+  except (OSError, IOError) as error:
+    return 'could not create a working directory ' + WorkingDirPrefix + \
+    '*: ' + str(error)
+
+  # RAxML requires the -w directory to be given as an absolute path.
+  RAxMLcall = RAxMLargList + ['-s', os.path.abspath(BootstrappedAlignment),
+  '-n', RunName, '-w', WorkingDir]
+  try:
+    with ToolSlots:
+      proc = subprocess.Popen(RAxMLcall, stdout=subprocess.PIPE,
+      stderr=subprocess.PIPE)
+      out, err = proc.communicate()
+  except OSError as error:
+    problem = 'could not run RAxML: ' + str(error)
+  else:
+    if proc.returncode != 0:
+      problem = 'RAxML returned an exit code of ' + str(proc.returncode) + \
+      ', printed this to stdout:\n' + out + \
+      '\nand printed this to stderr:\n' + err
+    elif not os.path.isfile(os.path.join(WorkingDir,
+    'RAxML_bestTree.' + RunName)):
+      problem = 'RAxML_bestTree.' + RunName + ', expected to be produced ' + \
+      'by RAxML, does not exist.'
+    else:
+      problem = None
+
+  # Whatever was produced, even by a failed replicate, is moved back.
+  for OutputFile in os.listdir(WorkingDir):
+    shutil.move(os.path.join(WorkingDir, OutputFile), OutputFile)
+  shutil.rmtree(WorkingDir, ignore_errors=True)
+  return problem
+
 def RunRAxML(alignment, RAxMLargList, WindowSuffix, WindowAsStr, LeftEdge,
 RightEdge, TempFilesSet, TempFileForAllBootstrappedTrees_basename,
-BootstrapSeed=None, NumBootstraps=None, TimesList=[]):
+BootstrapSeed=None, NumBootstraps=None, TimesList=[], NumBootstrapSlots=1,
+ToolSlots=None):
   '''Runs RAxML on aligned sequences in a window, with bootstraps if desired.
 
+  Up to NumBootstrapSlots bootstrap replicates are run at the same time. If
+  ToolSlots is given (a semaphore shared with whatever else is running external
+  programs), each call to RAxML waits until one of its slots is free.
   Returns 1 if an ML tree was produced (regardless of whether any subsequent
   bootstrapping worked), 0 if not.'''
 
   # Update on times if we weren't given an empty list
   UpdateTimes = TimesList != []
 
+  if ToolSlots == None:
+    ToolSlots = NoToolSlots()
+
   MLtreeFile = 'RAxML_bestTree.' + WindowSuffix + '.tree'
   RAxMLcall = RAxMLargList + ['-s', alignment, '-n',
   WindowSuffix+'.tree']
-  proc = subprocess.Popen(RAxMLcall, stdout=subprocess.PIPE,
-  stderr=subprocess.PIPE)
-  out, err = proc.communicate()
+  with ToolSlots:
+    proc = subprocess.Popen(RAxMLcall, stdout=subprocess.PIPE,
+    stderr=subprocess.PIPE)
+    out, err = proc.communicate()
   ExitStatus = proc.returncode
   if ExitStatus != 0:
     print('Problem making the ML tree with RAxML in window ', WindowAsStr,
@@ -263,9 +451,10 @@ BootstrapSeed=None, NumBootstraps=None, TimesList=[]):
   # If desired, make bootstrapped alignments
   if NumBootstraps != None:
     try:
-      ExitStatus = subprocess.call(RAxMLargList + ['-b',
-      str(BootstrapSeed), '-f', 'j', '-#', str(NumBootstraps), '-s',
-      alignment, '-n', WindowSuffix + '_bootstraps'])
+      with ToolSlots:
+        ExitStatus = subprocess.call(RAxMLargList + ['-b',
+        str(BootstrapSeed), '-f', 'j', '-#', str(NumBootstraps), '-s',
+        alignment, '-n', WindowSuffix + '_bootstraps'])
       assert ExitStatus == 0
     except:
       print('Problem generating bootstrapped alignments with RAxML in window ',
@@ -280,25 +469,43 @@ BootstrapSeed=None, NumBootstraps=None, TimesList=[]):
       '\nSkipping to the next window.', file=sys.stderr)
       return 1
 
-    # Make a tree for each bootstrap
-    for bootstrap,BootstrappedAlignment in enumerate(BootstrappedAlignments):
+    # Make a tree for each bootstrap, running up to NumBootstrapSlots
+    # replicates at once. Each replicate is run to completion (or failure)
+    # regardless of what happens to the others, so that every problem can be
+    # reported.
+    BootstrapRunNames = [WindowSuffix + '_bootstrap_' + str(bootstrap) + \
+    '.tree' for bootstrap in range(NumBootstraps)]
+    ReplicateArgs = [(RAxMLargList, BootstrappedAlignment,
+    BootstrapRunNames[bootstrap], 'BootstrapWorkingDir_' + \
+    BootstrapRunNames[bootstrap] + '_', ToolSlots) for bootstrap,
+    BootstrappedAlignment in \
+    enumerate(BootstrappedAlignments)]
+    NumSlots = max(1, min(NumBootstrapSlots, NumBootstraps))
+    if NumSlots == 1:
+      ReplicateProblems = [RunBootstrapReplicate(*ReplicateArg) for \
+      ReplicateArg in ReplicateArgs]
+    else:
+      pool = ThreadPool(NumSlots)
       try:
-        ExitStatus = subprocess.call(RAxMLargList + ['-s',
-        BootstrappedAlignment, '-n', WindowSuffix + '_bootstrap_' + \
-        str(bootstrap)+'.tree'])
-        assert ExitStatus == 0
-      except:
-        print('Problem generating a tree with RAxML for bootstrap',
-        str(bootstrap), '. Skipping subsequent bootstraps.', file=sys.stderr)
-        break
-    BootstrappedTrees = ['RAxML_bestTree.' +WindowSuffix +'_bootstrap_' +\
-    str(bootstrap) +'.tree' for bootstrap in range(NumBootstraps)]
-    if not all(os.path.isfile(BootstrappedTree) \
-    for BootstrappedTree in BootstrappedTrees):
-      print('At least one of the following files, expected to be produced by'+\
-      ' RAxML, is missing:\n', ' '.join(BootstrappedTrees)+\
-      '\nSkipping to the next window.', file=sys.stderr)
+        ReplicateProblems = pool.map(lambda ReplicateArg:
+        RunBootstrapReplicate(*ReplicateArg), ReplicateArgs)
+      finally:
+        pool.close()
+        pool.join()
+    FailedBootstraps = [bootstrap for bootstrap, problem in \
+    enumerate(ReplicateProblems) if problem != None]
+    for bootstrap in FailedBootstraps:
+      print('Problem generating a tree with RAxML for bootstrap ', bootstrap,
+      ' in window ', WindowAsStr, ': ', ReplicateProblems[bootstrap], sep='',
+      file=sys.stderr)
+    if FailedBootstraps:
+      print(NumBootstraps - len(FailedBootstraps), 'of', NumBootstraps,
+      'bootstrapped trees were made in window', WindowAsStr + '; bootstraps',
+      'are only summarised when all of them succeed. Skipping to the next',
+      'window.', file=sys.stderr)
       return 1
+    BootstrappedTrees = ['RAxML_bestTree.' + BootstrapRunName for \
+    BootstrapRunName in BootstrapRunNames]
 
     # Collect the trees from all bootstraps into one file
     TempAllBootstrappedTreesFile = TempFileForAllBootstrappedTrees_basename +\
@@ -312,8 +519,9 @@ BootstrapSeed=None, NumBootstraps=None, TimesList=[]):
     # Collect the trees from all bootstraps onto the ML tree
     MainTreeFile = 'MLtreeWbootstraps' +WindowSuffix +'.tree'
     try:
-      ExitStatus = subprocess.call(RAxMLargList + ['-f', 'b', '-t', MLtreeFile,
-       '-z', TempAllBootstrappedTreesFile, '-n', MainTreeFile])
+      with ToolSlots:
+        ExitStatus = subprocess.call(RAxMLargList + ['-f', 'b', '-t',
+        MLtreeFile, '-z', TempAllBootstrappedTreesFile, '-n', MainTreeFile])
       assert ExitStatus == 0
     except:
       print('Problem in window', WindowAsStr, 'trying to collect all the',
@@ -349,28 +557,130 @@ def TranslateSeqCoordsToAlnCoords(seq, coords):
   'TranslateSeqCoordsToAlnCoords called with coords not of int type.'
   assert all(coord > 0 for coord in coords), \
   'TranslateSeqCoordsToAlnCoords called with at least one non-positive coord.'
-  TranslatedCoords = [-1 for coord in coords]
-  PositionInSeq = 0
-  for GappyPostitionMin1,base in enumerate(seq):
-    if base != GapChar:
-      PositionInSeq += 1
-      for i,coord in enumerate(coords):
-        if coord == PositionInSeq:
-          TranslatedCoords[i] = GappyPostitionMin1+1
-      if not -1 in TranslatedCoords:
-        break
-  assert not -1 in TranslatedCoords, \
+  if len(coords) == 0:
+    return []
+  # The number of bases up to and including each position in the gappy seq; the
+  # position of base n is the first position where this reaches n.
+  BaseCounts = np.cumsum(np.frombuffer(seq, dtype=np.uint8) != ord(GapChar))
+  assert len(BaseCounts) > 0 and max(coords) <= BaseCounts[-1], \
   'TranslateSeqCoordsToAlnCoords failed to find at least one coord.'
+  return [int(position) + 1 for position in \
+  np.searchsorted(BaseCounts, coords)]
+
+def TranslateCoords(SeqDict, coords, ChosenRef=None, GapChars='-.?'):
+  '''Translates coordinates with respect to one sequence in an alignment (or
+  with respect to the alignment itself, if ChosenRef is None) to coordinates
+  with respect to every sequence in the alignment.
+
+  SeqDict should be an ordered dict of the aligned sequences (as strings) by
+  name; an ordered dict of lists of translated coordinates by name is returned.
+  A coordinate before the start of a sequence is translated to -1, one after its
+  end to 'NaN', and one inside a gap to the position of the base before the gap
+  plus 0.5. ValueError is raised if the coordinates or sequences are unusable.'''
+
+  if len(SeqDict) == 0:
+    raise ValueError('there are no sequences.')
+  SeqNames = list(SeqDict.keys())
+  seqs = list(SeqDict.values())
+  AlignmentLength = len(seqs[0])
+  if any(len(seq) != AlignmentLength for seq in seqs):
+    raise ValueError("the sequences are not all of the same length - it's " +\
+    'supposed to be an alignment.')
+  if any(coord < 1 for coord in coords):
+    raise ValueError('all coordinates must be greater than zero.')
+
+  # For each sequence, the number of bases up to and including each column.
+  SeqMatrix = np.frombuffer(''.join(seqs), dtype=np.uint8).reshape(len(seqs),
+  AlignmentLength)
+  IsBase = ~np.in1d(SeqMatrix, np.frombuffer(GapChars,
+  dtype=np.uint8)).reshape(SeqMatrix.shape)
+  BaseCounts = np.cumsum(IsBase, axis=1)
+  for SeqName, NumBases in zip(SeqNames, BaseCounts[:, -1]):
+    if NumBases == 0:
+      raise ValueError(SeqName + " has no bases, it's just one big gap.")
+
+  # Find the (zero-based) columns of the coordinates. For a chosen reference,
+  # the column of base n is the first column where its base count reaches n.
+  coords = np.array(coords, dtype=int)
+  if ChosenRef == None:
+    TooLargeCoords = coords[coords > AlignmentLength]
+    if len(TooLargeCoords) > 0:
+      raise ValueError('coordinates ' + ', '.join(map(str, TooLargeCoords)) + \
+      ' occur after the end of the alignment (' + str(AlignmentLength) + \
+      ' bases long).')
+    columns = coords - 1
+  else:
+    if not ChosenRef in SeqDict:
+      raise ValueError('could not find ' + ChosenRef + '.')
+    RefBaseCounts = BaseCounts[SeqNames.index(ChosenRef)]
+    TooLargeCoords = coords[coords > RefBaseCounts[-1]]
+    if len(TooLargeCoords) > 0:
+      raise ValueError('coordinates ' + ', '.join(map(str, TooLargeCoords)) + \
+      ' occur after the end of ' + ChosenRef + ' (' + \
+      str(RefBaseCounts[-1]) + ' bases long).')
+    columns = np.searchsorted(RefBaseCounts, coords)
+
+  # Translate the columns to positions in each sequence.
+  SeqStarts = IsBase.argmax(axis=1)
+  SeqEnds = AlignmentLength - 1 - IsBase[:, ::-1].argmax(axis=1)
+  TranslatedCoords = collections.OrderedDict()
+  for row, SeqName in enumerate(SeqNames):
+    CoordsInThisSeq = []
+    for column, count, BaseHere in zip(columns, BaseCounts[row, columns],
+    IsBase[row, columns]):
+      if column < SeqStarts[row]:
+        CoordsInThisSeq.append(-1)
+      elif column > SeqEnds[row]:
+        CoordsInThisSeq.append('NaN')
+      elif BaseHere:
+        CoordsInThisSeq.append(int(count))
+      else:
+        CoordsInThisSeq.append(int(count) + 0.5)
+    TranslatedCoords[SeqName] = CoordsInThisSeq
   return TranslatedCoords
 
 
-class PseudoRead:
-  "A class similar to pysam.AlignedSegment. Writable, and with extra features."
+# PseudoRead positions are stored as an array of int32, with this value standing
+# for bases not mapped to the reference. (Positions can be negative, when
+# clipped ends are recovered, so -1 cannot be used.)
+UnmappedPosition = np.iinfo(np.int32).min
+
+# The CIGAR operations that consume bases of the read and of the reference:
+# M, I, D, N, S, H, P, =, X, B.
+CigarConsumesQuery = (True, True, False, False, True, False, False, True, True,
+False)
+CigarConsumesRef = (True, False, True, True, False, False, False, True, True,
+False)
+
+def FirstAndLastTrue(BoolArray):
+  '''Returns the indices of the first and last True values in a numpy array of
+  bools, or None if there are none.'''
+  if BoolArray.size == 0:
+    return None
+  first = BoolArray.argmax()
+  if not BoolArray[first]:
+    return None
+  return first, len(BoolArray) - 1 - BoolArray[::-1].argmax()
+
+class PseudoRead(object):
+  '''A class similar to pysam.AlignedSegment. Writable, and with extra features.
+
+  Positions are a numpy array of int32 in which unmapped bases have the value
+  UnmappedPosition; qualities are a numpy array of uint8.'''
+
+  __slots__ = ('name', 'sequence', 'positions', 'qualities')
 
   def __init__(self, name, sequence, positions, qualities):
-    "A manual constructor. At least one position must not be None."
+    '''A manual constructor. At least one position must be mapped. Positions and
+    qualities may be given as numpy arrays or as lists, in which case None is
+    used for unmapped positions.'''
+    if not isinstance(positions, np.ndarray):
+      positions = np.array([UnmappedPosition if pos == None else pos \
+      for pos in positions], dtype=np.int32)
+    if not isinstance(qualities, np.ndarray):
+      qualities = np.array(qualities, dtype=np.uint8)
     assert len(sequence) == len(positions) == len(qualities) > 0
-    assert any(value != None for value in positions)
+    assert (positions != UnmappedPosition).any()
     self.name = name
     self.sequence = sequence
     self.positions = positions
@@ -381,62 +691,77 @@ class PseudoRead:
     '''A constructor for pysam.AlignedSegments.
     Not a true constructor, but a decorated class method: the pythonic 
     work-around for multiple constructors.'''
-    positions = read.get_reference_positions(full_length=True)
-    if not len(read.query_sequence) == len(positions) == \
-    len(read.query_qualities) > 0:
+
+    # Equivalent to read.get_reference_positions(full_length=True), but made
+    # directly as an array: mapped stretches of the read from the CIGAR are
+    # filled in with ranges of positions.
+    positions = np.empty(read.query_length, dtype=np.int32)
+    positions.fill(UnmappedPosition)
+    PosInRead = 0
+    PosInRef = read.reference_start
+    for operation, length in read.cigartuples:
+      if CigarConsumesQuery[operation]:
+        if CigarConsumesRef[operation]:
+          positions[PosInRead:PosInRead+length] = \
+          np.arange(PosInRef, PosInRef+length)
+        PosInRead += length
+      if CigarConsumesRef[operation]:
+        PosInRef += length
+
+    qualities = np.frombuffer(read.query_qualities, dtype=np.uint8)
+    if not len(read.query_sequence) == PosInRead == len(positions) == \
+    len(qualities) > 0:
       print('Unexpected attribute properties for pysam.AlignedSegment\n', read,
       '\nSpecifically, expected equal numbers of bases, mapped positions and ',
       'base qualities, but found ', len(read.query_sequence), ', ', 
-      len(positions), ' and ', len(read.query_qualities),
+      PosInRead, ' and ', len(qualities),
       ' respectively. Quitting.', sep='', file=sys.stderr)
       exit(1)
-    return cls(read.query_name, read.query_sequence, positions,
-    read.query_qualities)
+    return cls(read.query_name, read.query_sequence, positions, qualities)
+
+  def PositionsAsStrings(self):
+    "Returns the positions as strings, with 'None' for unmapped bases."
+    return ['None' if pos == UnmappedPosition else str(pos) \
+    for pos in self.positions]
 
   def __repr__(self):
     'Defining how a PseudoRead can be printed'
     return 'name: %s\nseq: %s\npositions: %s\nqualities: %s' % (self.name,
-    self.sequence, ' '.join(map(str,self.positions)),
+    self.sequence, ' '.join(self.PositionsAsStrings()),
     ' '.join(map(str,self.qualities)))
 
+  def MappedEdges(self):
+    '''Returns the indices in the read of the left-most and right-most mapped
+    bases, or None if no bases are mapped.'''
+    return FirstAndLastTrue(self.positions != UnmappedPosition)
+
   def SpansWindow(self, LeftWindowEdge, RightWindowEdge, ExactWindowStart,
     ExactWindowEnd):
     "Returns True if the read fully spans the specified window."
     assert LeftWindowEdge <= RightWindowEdge
-    LeftMostMappedBase = 0
-    try:
-      while self.positions[LeftMostMappedBase] == None:
-        LeftMostMappedBase += 1
-    except IndexError:
+    MappedEdges = self.MappedEdges()
+    if MappedEdges == None:
       return False
-    if self.positions[LeftMostMappedBase] > LeftWindowEdge:
+    LeftMostMappedPos = self.positions[MappedEdges[0]]
+    RightMostMappedPos = self.positions[MappedEdges[1]]
+    if LeftMostMappedPos > LeftWindowEdge:
       return False
-    if ExactWindowStart and self.positions[LeftMostMappedBase] != \
-    LeftWindowEdge:
+    if ExactWindowStart and LeftMostMappedPos != LeftWindowEdge:
       return False
-    RightMostMappedBase = len(self.positions)-1
-    while self.positions[RightMostMappedBase] == None:
-      RightMostMappedBase -= 1
-    if ExactWindowEnd and self.positions[RightMostMappedBase] != \
-    RightWindowEdge:
+    if ExactWindowEnd and RightMostMappedPos != RightWindowEdge:
       return False
-    return self.positions[RightMostMappedBase] >= RightWindowEdge
+    return RightMostMappedPos >= RightWindowEdge
 
   def QualityTrimEnds(self, MinQual):
     '''Trims inwards until a base of sufficient quality is met.
     Returns a blank read if no bases are of sufficient quality.'''
-    FirstHighQBase = 0
-    try:
-      while self.qualities[FirstHighQBase] < MinQual:
-        FirstHighQBase += 1
-    except IndexError:
+    HighQBaseEdges = FirstAndLastTrue(self.qualities >= MinQual)
+    if HighQBaseEdges == None:
       self.sequence = ''
-      self.positions = []
-      self.qualities = []
+      self.positions = self.positions[:0]
+      self.qualities = self.qualities[:0]
     else:
-      LastHighQBase = len(self.positions)-1
-      while self.qualities[LastHighQBase] < MinQual:
-        LastHighQBase -= 1
+      FirstHighQBase, LastHighQBase = HighQBaseEdges
       self.sequence  = self.sequence[FirstHighQBase:LastHighQBase+1]
       self.positions = self.positions[FirstHighQBase:LastHighQBase+1]
       self.qualities = self.qualities[FirstHighQBase:LastHighQBase+1]
@@ -444,19 +769,13 @@ class PseudoRead:
   def IsLowQual(self, MinQual):
     '''Returns True if two or more bases are below the quality threshold, False
     otherwise.'''
-    NumLowQbases = 0
-    for qual in self.qualities:
-      if qual < MinQual:
-        NumLowQbases += 1
-        if NumLowQbases == 2:
-          return True
-    return False
+    return np.count_nonzero(self.qualities < MinQual) >= 2
 
   def RecoverClippedEnds(self):
-    '''Replaces any 'None' mapped positions at read ends to continuous ints.
+    '''Replaces any unmapped positions at read ends to continuous ints.
 
     Recovers clipped ends by considering any bases at the ends of the read
-    that are mapped to 'None' to be mapped instead to 1 more than the base to
+    that are unmapped to be mapped instead to 1 more than the base to
     the left (at the right end) or 1 less than the base to the right (at the
     end left). e.g. a 9bp read mapped to positions
     None,None,10,11,13,14,None,None,None
@@ -469,28 +788,20 @@ class PseudoRead:
     of the reference will be considered mapped to positions greater than the
     length of the reference.'''
 
-    LeftMostMappedBase = 0
-    try:
-      while self.positions[LeftMostMappedBase] == None:
-        LeftMostMappedBase += 1
-    except IndexError:
-      # Every base mapped to None.
-      pass
-    else:
-      ReadLength = len(self.positions)
-      RightMostMappedBase = ReadLength - 1
-      while self.positions[RightMostMappedBase] == None:
-        RightMostMappedBase -= 1
-      if LeftMostMappedBase > 0:
-        #print(self.positions)
-        RefPosOfLeftEdge = self.positions[LeftMostMappedBase]
-        for i in range(LeftMostMappedBase):
-          self.positions[i] = RefPosOfLeftEdge - LeftMostMappedBase + i
-      if RightMostMappedBase < ReadLength - 1:
-        #print(self.positions)
-        RefPosOfRightEdge = self.positions[RightMostMappedBase]
-        for i in range(RightMostMappedBase + 1, ReadLength):
-          self.positions[i] = RefPosOfRightEdge + i - RightMostMappedBase
+    MappedEdges = self.MappedEdges()
+    if MappedEdges == None:
+      # Every base unmapped.
+      return
+    ReadLength = len(self.positions)
+    LeftMostMappedBase, RightMostMappedBase = MappedEdges
+    if LeftMostMappedBase > 0:
+      RefPosOfLeftEdge = self.positions[LeftMostMappedBase]
+      self.positions[:LeftMostMappedBase] = \
+      np.arange(RefPosOfLeftEdge - LeftMostMappedBase, RefPosOfLeftEdge)
+    if RightMostMappedBase < ReadLength - 1:
+      RefPosOfRightEdge = self.positions[RightMostMappedBase]
+      self.positions[RightMostMappedBase + 1:] = np.arange(RefPosOfRightEdge+1,
+      RefPosOfRightEdge + ReadLength - RightMostMappedBase)
 
 
   def ProcessRead(self, LeftWindowEdge, RightWindowEdge, MinQualForEnds,
@@ -534,35 +845,49 @@ class PseudoRead:
     # if both are true we do care about the start and end but we've already
     # preselected the reads to start and end at exactly the points of interest.
     if not KeepOverhangs:
+      Mapped = self.positions != UnmappedPosition
       if ExactWindowStart or ExactWindowEnd:
         # Do this so that the only bases to get trimmed are unmapped ones at the
         # edges.
-        LeftWindowEdge = float('-Inf')
-        RightWindowEdge = float('Inf')
-      try:
-        LeftEdgePositionInRead = 0
-        while self.positions[LeftEdgePositionInRead] == None or \
-        self.positions[LeftEdgePositionInRead] < LeftWindowEdge:
-          LeftEdgePositionInRead += 1
-        RightEdgePositionInRead = len(self.positions)-1
-        while self.positions[RightEdgePositionInRead] == None or \
-        self.positions[RightEdgePositionInRead] > RightWindowEdge:
-          RightEdgePositionInRead -= 1
-        assert LeftEdgePositionInRead <= RightEdgePositionInRead
-      except (IndexError, AssertionError):
+        LeftEdgeCandidates = np.flatnonzero(Mapped)
+        RightEdgeCandidates = LeftEdgeCandidates
+      else:
+        LeftEdgeCandidates = np.flatnonzero(Mapped &
+        (self.positions >= LeftWindowEdge))
+        RightEdgeCandidates = np.flatnonzero(Mapped &
+        (self.positions <= RightWindowEdge))
+      if len(LeftEdgeCandidates) == 0 or len(RightEdgeCandidates) == 0 or \
+      LeftEdgeCandidates[0] > RightEdgeCandidates[-1]:
+        if ExactWindowStart or ExactWindowEnd:
+          LeftWindowEdge = float('-Inf')
+          RightWindowEdge = float('Inf')
         print('Unexpected behaviour for read', self.name+', which',
         'maps to the following positions in the reference:\n'+ \
-        ' '.join(map(str,self.positions)) +'\nUnable to determine ',
+        ' '.join(self.PositionsAsStrings()) +'\nUnable to determine ',
         'where the window edges ('+str(LeftWindowEdge+1), 'and',
         str(RightWindowEdge+1)+') are in this read. Skipping it.',
         file=sys.stderr)
         return None
+      LeftEdgePositionInRead = LeftEdgeCandidates[0]
+      RightEdgePositionInRead = RightEdgeCandidates[-1]
       SeqToReturn = \
       SeqToReturn[LeftEdgePositionInRead:RightEdgePositionInRead+1]
 
     return SeqToReturn
 
 
+  def AgreesOnOverlap(self, other, OverlapStart):
+    '''Returns True if, starting the other read at the given base of this one,
+    the reads agree on the bases and positions of the overlap, and at least one
+    position in the overlap is mapped.'''
+    OverlapLength = min(len(other.positions), len(self.positions) -OverlapStart)
+    OverlapPositions = self.positions[OverlapStart:OverlapStart+OverlapLength]
+    return self.sequence[OverlapStart:OverlapStart+OverlapLength] == \
+    other.sequence[:OverlapLength] and \
+    np.array_equal(OverlapPositions, other.positions[:OverlapLength]) and \
+    (OverlapPositions != UnmappedPosition).any()
+
+
   def MergeReadPairOverWindow(self, other, LeftWindowEdge, RightWindowEdge,
   MinQualForEnds, MinInternalQual, RecoverClippedEnds):
     '''TODO:
@@ -585,11 +910,12 @@ class PseudoRead:
         return None
 
     # Check that the pair overlap and span the window. If not, return None.
-    SelfLeftEdge  = next(pos for pos in self.positions if pos != None)
-    SelfRightEdge = next(pos for pos in reversed(self.positions) if pos != None)
-    OtherLeftEdge  = next(pos for pos in other.positions if pos != None)
-    OtherRightEdge = next(pos for pos in reversed(other.positions) \
-    if pos != None)
+    SelfMappedEdges = self.MappedEdges()
+    OtherMappedEdges = other.MappedEdges()
+    SelfLeftEdge  = self.positions[SelfMappedEdges[0]]
+    SelfRightEdge = self.positions[SelfMappedEdges[1]]
+    OtherLeftEdge  = other.positions[OtherMappedEdges[0]]
+    OtherRightEdge = other.positions[OtherMappedEdges[1]]
     if OtherRightEdge < SelfLeftEdge or OtherLeftEdge > SelfRightEdge or \
     min(SelfLeftEdge, OtherLeftEdge) > LeftWindowEdge or \
     max(SelfRightEdge, OtherRightEdge) < RightWindowEdge:
@@ -599,37 +925,40 @@ class PseudoRead:
     # *including unmapped bases*. This is the position of the left-most mapped
     # base, minus the number of unmapped bases to its left. Find which of
     # the two reads has this position more to the left. 
-    SelfStartIncClipping  = SelfLeftEdge  - self.positions.index(SelfLeftEdge)
-    OtherStartIncClipping = OtherLeftEdge - other.positions.index(OtherLeftEdge)
+    SelfStartIncClipping  = SelfLeftEdge  - SelfMappedEdges[0]
+    OtherStartIncClipping = OtherLeftEdge - OtherMappedEdges[0]
     if SelfStartIncClipping < OtherStartIncClipping:
       LeftRead = self
       RightRead = other
+      FirstMappedBaseInRightRead = OtherMappedEdges[0]
     else:
       LeftRead = other
       RightRead = self
+      FirstMappedBaseInRightRead = SelfMappedEdges[0]
     Length_LeftRead  = len(LeftRead.positions)
     Length_RightRead = len(RightRead.positions)
 
-    # Slide the reads along each other until we find a position such that 
-    # they agree perfectly on the overlap - both on the bases it contains,
+    # We want the first position of the right read along the left read such 
+    # that they agree perfectly on the overlap - both on the bases it contains,
     # and on the positions mapped to in the reference. At least one position in
     # the overlap must be mapped, i.e. they can't all be mapped to 'None'.
     # If no such position is found, they disagree: return False.
+    # Any such overlap contains the first mapped base of the right read, so the
+    # left read must map a base to the same position. Mapped positions in a
+    # read are normally all different, so there is only one place the overlap
+    # could start, which we check. Only if the position occurs more than once
+    # in the left read do we slide the reads along each other to find the
+    # first place they agree.
+    MatchingBasesInLeftRead = np.flatnonzero(LeftRead.positions ==
+    RightRead.positions[FirstMappedBaseInRightRead])
     OverlapStartInLeftRead = None
-    for j in range(Length_LeftRead):
-      this_j_works = True
-      for k in range(min(Length_RightRead, Length_LeftRead -j)):
-        if LeftRead.positions[j+k] != RightRead.positions[k] or \
-        LeftRead.sequence[j+k] != RightRead.sequence[k]:
-          this_j_works = False
-          break
-      if this_j_works:
-        AtLeastOnePosMapped = False
-        for k in range(min(Length_RightRead, Length_LeftRead -j)):
-          if LeftRead.positions[j+k] != None:
-            AtLeastOnePosMapped = True
-            break
-        if AtLeastOnePosMapped:
+    if len(MatchingBasesInLeftRead) == 1:
+      j = MatchingBasesInLeftRead[0] - FirstMappedBaseInRightRead
+      if j >= 0 and LeftRead.AgreesOnOverlap(RightRead, j):
+        OverlapStartInLeftRead = j
+    elif len(MatchingBasesInLeftRead) > 1:
+      for j in range(Length_LeftRead):
+        if LeftRead.AgreesOnOverlap(RightRead, j):
           OverlapStartInLeftRead = j
           break
     if OverlapStartInLeftRead == None:
@@ -639,25 +968,22 @@ class PseudoRead:
     # overlap to be the larger from the two reads. (As opposed to a quality
     # corresponding to the probability that both reads independently made the
     # same miscall, for example.)
+    OverlapEndInLeftRead = OverlapStartInLeftRead + Length_RightRead
     merged_sequence = LeftRead.sequence[:OverlapStartInLeftRead] +\
     RightRead.sequence +\
-    LeftRead.sequence[OverlapStartInLeftRead+Length_RightRead:]
-    merged_positions = LeftRead.positions[:OverlapStartInLeftRead] +\
-    RightRead.positions +\
-    LeftRead.positions[OverlapStartInLeftRead+Length_RightRead:]
-    merged_qualities = LeftRead.sequence[:OverlapStartInLeftRead]
-    for j in range(
-    max(Length_LeftRead - OverlapStartInLeftRead, Length_RightRead)):
-      try:
-        BaseQLeftRead = LeftRead.sequence[OverlapStartInLeftRead+j]
-      except IndexError:
-        BaseQLeftRead  = float('-inf')
-      try:
-        BaseQRightRead = RightRead.sequence[j]
-      except IndexError:
-        BaseQRightRead = float('-inf')
-      BestBaseQ = max(BaseQLeftRead, BaseQRightRead)
-      merged_qualities += BestBaseQ
+    LeftRead.sequence[OverlapEndInLeftRead:]
+    merged_positions = np.concatenate((
+    LeftRead.positions[:OverlapStartInLeftRead],
+    RightRead.positions,
+    LeftRead.positions[OverlapEndInLeftRead:]))
+    OverlapLength = min(Length_RightRead,
+    Length_LeftRead - OverlapStartInLeftRead)
+    merged_qualities = np.concatenate((
+    LeftRead.qualities[:OverlapStartInLeftRead],
+    np.maximum(LeftRead.qualities[OverlapStartInLeftRead:
+    OverlapStartInLeftRead+OverlapLength], RightRead.qualities[:OverlapLength]),
+    RightRead.qualities[OverlapLength:],
+    LeftRead.qualities[OverlapEndInLeftRead:]))
     assert len(merged_qualities) == len(merged_sequence)
     MergedRead = PseudoRead(self.name, merged_sequence,
     merged_positions, merged_qualities)
@@ -711,6 +1037,103 @@ def ResolveTree(tree):
       break
   return ResolvedCladesAtThisLevel
 
+def PatristicDistances(tree):
+  '''Returns a numpy matrix of the patristic distances between all pairs of tips
+  in a Bio.Phylo tree, with tips in the same order as tree.get_terminals().
+
+  The distance between two tips is the sum of their distances from the root
+  minus twice that of their most recent common ancestor, which is the node at
+  which their lineages split. Missing branch lengths count as zero. The tree is
+  traversed without recursion, so that very deep trees are fine.'''
+  # Find each node's distance from the root, parents before children, and
+  # number the tips in the order found.
+  NodesAndDepths = []
+  TipIndices = {}
+  TipDepths = []
+  stack = [(tree.root, 0)]
+  while stack:
+    node, depth = stack.pop()
+    NodesAndDepths.append((node, depth))
+    if node.clades:
+      for child in reversed(node.clades):
+        stack.append((child, depth + (child.branch_length or 0)))
+    else:
+      TipIndices[id(node)] = len(TipDepths)
+      TipDepths.append(depth)
+  TipDepths = np.array(TipDepths)
+  distances = TipDepths[:, np.newaxis] + TipDepths[np.newaxis, :]
+
+  # Children before parents: at each node, each pair of tips below different
+  # children has that node as its most recent common ancestor.
+  TipsBelow = {}
+  for node, depth in reversed(NodesAndDepths):
+    if not node.clades:
+      TipsBelow[id(node)] = [TipIndices[id(node)]]
+      continue
+    TipsBelowChildren = [TipsBelow.pop(id(child)) for child in node.clades]
+    for i, TipsBelowChild in enumerate(TipsBelowChildren):
+      for OtherTipsBelowChild in TipsBelowChildren[i + 1:]:
+        distances[np.ix_(TipsBelowChild, OtherTipsBelowChild)] -= 2 * depth
+        distances[np.ix_(OtherTipsBelowChild, TipsBelowChild)] -= 2 * depth
+    TipsBelow[id(node)] = [tip for TipsBelowChild in TipsBelowChildren for \
+    tip in TipsBelowChild]
+
+  np.fill_diagonal(distances, 0)
+  return distances
+
+def MedianPatristicDistance(tree):
+  '''Returns the median of the patristic distances between all possible pairs
+  of tips in a Bio.Phylo tree.'''
+  distances = PatristicDistances(tree)
+  return np.median(distances[np.triu_indices(len(distances), 1)])
+
+def StringsAsMatrix(strings):
+  '''Encodes strings as a numpy matrix of uint8, with one row per string padded
+  at the end with zeros, and returns it with an array of the string lengths.'''
+  lengths = np.array([len(string) for string in strings], dtype=np.int64)
+  if len(strings) == 0:
+    return np.zeros((0, 0), dtype=np.uint8), lengths
+  matrix = np.zeros((len(strings), lengths.max()), dtype=np.uint8)
+  for row, string in enumerate(strings):
+    matrix[row, :len(string)] = np.frombuffer(string, dtype=np.uint8)
+  return matrix, lengths
+
+def StringsWithinThreshold(string, matrix, lengths, rows, SimilarityThreshold):
+  '''Compares one string with many, returning an array of bools saying which
+  are within the similarity threshold of it.
+
+  The strings compared with are the given rows (an array of indices) of a
+  matrix made by StringsAsMatrix, whose string lengths are also given. The
+  number of differences between two strings is taken to be the difference in
+  their lengths plus the number of differing characters over the length of the
+  shorter one. Strings whose lengths alone differ by more than the threshold are
+  not compared character by character.'''
+
+  length = len(string)
+  WithinThreshold = np.zeros(len(rows), dtype=bool)
+  LengthDiffs = np.abs(lengths[rows] - length)
+  ToCompare = np.flatnonzero(LengthDiffs <= SimilarityThreshold)
+  if len(ToCompare) == 0:
+    return WithinThreshold
+
+  # Compare characters up to the length of this string or the width of the
+  # matrix. Beyond the end of a shorter string in the matrix, its padding
+  # differs from every character of this one, so each of those positions
+  # counts as one difference: exactly the difference in lengths. For strings
+  # longer than this one, the difference in lengths is added separately, as it
+  # is for characters of this one beyond the width of the matrix.
+  width = min(length, matrix.shape[1])
+  encoded = np.frombuffer(string, dtype=np.uint8)[:width]
+  NumDiffs = np.count_nonzero(matrix[rows[ToCompare], :width] != encoded,
+  axis=1)
+  NumDiffs += length - width
+  NumDiffs += np.maximum(lengths[rows[ToCompare]] - length, 0)
+  WithinThreshold[ToCompare] = NumDiffs <= SimilarityThreshold
+  return WithinThreshold
+
+# The number of strings compared at once in MergeSimilarStringsB.
+MergingBlockSize = 256
+
 def MergeSimilarStringsB(DictOfStringCounts, SimilarityThreshold=1):
   '''Absorbs those strings with lower counts into those with higher counts.
 
@@ -754,36 +1177,33 @@ def MergeSimilarStringsB(DictOfStringCounts, SimilarityThreshold=1):
 
   # Sort the strings by their counts
   SortedDict = sorted(DictOfStringCounts.items(), key=lambda x: x[1])
+  matrix, lengths = StringsAsMatrix([string for string, count in SortedDict])
 
   # Iterate i forwards through the strings, rarest first.
   MergedDict = {}
   for i,(RareString,RareCount) in enumerate(SortedDict):
 
     # Iterate j backwards through the strings, from the most common one to the
-    # current one.
-    MatchesAnotherString = False
+    # current one. The comparison of all of these with this one is done at once:
+    # the number of differences between two strings is the difference in their
+    # length plus the number of differing characters over the length of the
+    # shorter string. We stop at the first j whose string differs in length by
+    # more than the threshold. If we find a j to merge with, we don't have to
+    # check smaller j, so the comparison is done in blocks of j, stopping after
+    # the first block containing a match.
     MatchingString = None
-    for j in reversed(xrange(i+1,NumberOfUniqueStrings)):
-
-      CommonString, CommonCount = SortedDict[j]
-
-      # Compare the two strings. Initialise the number of differences as the
-      # difference in string length, then do a pairwise comparison of characters
-      # over the length of the shorter string. As soon as the number of 
-      # differences exceeds the threshold, we know we shouldn't be merging them. 
-      NumDifferingBases = abs(len(RareString) - len(CommonString))
-      if NumDifferingBases > SimilarityThreshold:
-        break
-      for base1, base2 in itertools.izip(RareString, CommonString):
-        if base1 != base2:
-          NumDifferingBases += 1
-          if NumDifferingBases > SimilarityThreshold:
-            break
-      # If we're merging these two strings, we don't have to check smaller j,
-      # so we break.
-      if NumDifferingBases <= SimilarityThreshold:
-        MatchingString = CommonString
-        MatchingCount  = CommonCount
+    rows = np.arange(NumberOfUniqueStrings - 1, i, -1)
+    LengthTooDifferent = \
+    np.abs(lengths[rows] - len(RareString)) > SimilarityThreshold
+    if LengthTooDifferent.any():
+      rows = rows[:LengthTooDifferent.argmax()]
+    for BlockStart in xrange(0, len(rows), MergingBlockSize):
+      BlockRows = rows[BlockStart:BlockStart + MergingBlockSize]
+      WithinThreshold = StringsWithinThreshold(RareString, matrix, lengths,
+      BlockRows, SimilarityThreshold)
+      if WithinThreshold.any():
+        j = BlockRows[WithinThreshold.argmax()]
+        MatchingString, MatchingCount = SortedDict[j]
         break
 
     # NB either string (rare or matching) will already be in MergedDict if and
@@ -825,6 +1245,101 @@ def GenerateRandomSequence(length, bases='ACGT'):
   return ''.join(random.choice(bases) for _ in range(length))
 
 
+def AlignmentAsMatrix(alignment):
+  '''Returns a numpy matrix of uint8 (character codes) with one row per seq in
+  the alignment and one column per position.'''
+  return np.frombuffer(''.join(str(seq.seq) for seq in alignment),
+  dtype=np.uint8).reshape(len(alignment), alignment.get_alignment_length())
+
+def ConsensusOfReads(ReadsAndCounts, AlignmentLength):
+  '''Returns the most common character (which could be a gap) at each position
+  of a set of aligned reads, as a string.
+
+  ReadsAndCounts should be a dict whose keys are the reads (strings of length
+  AlignmentLength) and whose values are how many times each read was seen, by
+  which each is weighted. The reads are tallied all at once as a matrix, rather
+  than one character at a time. Where characters tie for most common, the same
+  one is chosen as by counting each position's characters in a dict, looping
+  through ReadsAndCounts in order, and taking the first of the dict's characters
+  with the highest count.'''
+  reads = list(ReadsAndCounts.keys())
+  counts = np.array([ReadsAndCounts[read] for read in reads], dtype=float)
+  matrix = np.frombuffer(''.join(reads), dtype=np.uint8).reshape(len(reads),
+  AlignmentLength)
+
+  # Tally each character code at each position, weighted by read count.
+  tallies = np.bincount((matrix.astype(np.intp) + \
+  256 * np.arange(AlignmentLength)).ravel(),
+  weights=np.repeat(counts, AlignmentLength),
+  minlength=256 * AlignmentLength).reshape(AlignmentLength, 256)
+  HighestCounts = tallies.max(axis=1)
+  consensus = tallies.argmax(axis=1).astype(np.uint8)
+
+  # Ties are rare; break them as described above.
+  NumMostCommon = (tallies == HighestCounts[:, np.newaxis]).sum(axis=1)
+  for pos in np.flatnonzero(NumMostCommon > 1):
+    BaseCounterDict = {}
+    for read, count in ReadsAndCounts.items():
+      base = read[pos]
+      if base in BaseCounterDict:
+        BaseCounterDict[base] += count
+      else:
+        BaseCounterDict[base] = count
+    MostCommonBase = None
+    HighestCount = 0
+    for base, count in BaseCounterDict.items():
+      if count > HighestCount:
+        MostCommonBase = base
+        HighestCount = count
+    consensus[pos] = ord(MostCommonBase)
+  return consensus.tobytes()
+
+def AlignmentWithColumns(alignment, ColumnsToKeep):
+  '''Returns a new alignment containing only those columns of the given one
+  for which ColumnsToKeep (a numpy array of bools) is True.
+
+  Each seq keeps its ID, name and description. The new alignment is made in one
+  go, rather than by removing columns one at a time.'''
+  matrix = AlignmentAsMatrix(alignment)[:, ColumnsToKeep]
+  NewAlignment = MultipleSeqAlignment([])
+  for row, seq in enumerate(alignment):
+    NewAlignment.append(SeqRecord(Seq(matrix[row].tobytes()), id=seq.id,
+    name=seq.name, description=seq.description))
+  return NewAlignment
+
+def AlignmentWithoutPositions(alignment, positions):
+  '''Returns a new alignment lacking the given positions (counting from 1),
+  removing them all in one pass.'''
+  ColumnsToKeep = np.ones(alignment.get_alignment_length(), dtype=bool)
+  ColumnsToKeep[np.array(positions, dtype=int) - 1] = False
+  return AlignmentWithColumns(alignment, ColumnsToKeep)
+
+def AlignmentWindow(alignment, matrix, LeftCoord, RightCoord, SkipBlanks=False,
+GapChars='-?'):
+  '''Returns the window LeftCoord-RightCoord (inclusive, from 1) of an alignment.
+
+  matrix should be AlignmentAsMatrix(alignment), so that it can be made once and
+  reused for many windows. Gaps are kept. Each seq keeps its ID, name and
+  description. If SkipBlanks=True, seqs consisting entirely of gap characters in
+  the window are left out. A ValueError is raised if the window extends beyond
+  the end of the alignment.'''
+  if RightCoord > matrix.shape[1]:
+    raise ValueError('A window ' + str(LeftCoord) + '-' + str(RightCoord) + \
+    ' was specified but the alignment is only ' + str(matrix.shape[1]) + \
+    ' bases long.')
+  WindowMatrix = matrix[:, LeftCoord-1:RightCoord]
+  if SkipBlanks:
+    IsGap = np.in1d(WindowMatrix, np.frombuffer(GapChars, dtype=np.uint8))
+    RowsToKeep = ~IsGap.reshape(WindowMatrix.shape).all(axis=1)
+  else:
+    RowsToKeep = np.ones(len(alignment), dtype=bool)
+  NewAlignment = MultipleSeqAlignment([])
+  for row, seq in enumerate(alignment):
+    if RowsToKeep[row]:
+      NewAlignment.append(SeqRecord(Seq(WindowMatrix[row].tobytes()),
+      id=seq.id, name=seq.name, description=seq.description))
+  return NewAlignment
+
 def CalculateRecombinationMetric(SeqAlignment, NormaliseToDiversity, IncludeGaps=False):
   '''Considers all triplets of seqs and finds the maximum recombination signal.
   
@@ -874,8 +1389,9 @@ def CalculateRecombinationMetric(SeqAlignment, NormaliseToDiversity, IncludeGaps
   
   For speed, Hamming distances are calculated indirectly - looking only at
   informative sites, and considering only changes in distance each time the
-  break point is slid through the next such site. However, runtime necessarily
-  scales as N^3, where N is the number of sequences.
+  break point is slid through the next such site - and for each pair of parents,
+  with numpy for all recombinants at once. However, runtime necessarily scales
+  as N^3, where N is the number of sequences.
 
   The function returns a tuple of length four: (metric, ID of parent 1, ID of
   parent 2, ID of recombinant). If the metric is exactly zero, i.e. no
@@ -893,90 +1409,74 @@ def CalculateRecombinationMetric(SeqAlignment, NormaliseToDiversity, IncludeGaps
   # Also calculate the number of positions at which at least one sequence does
   # not have a gap.
   AlignmentLength = SeqAlignment.get_alignment_length()
-  NumPureGapCols = 0
-  for column in reversed(xrange(AlignmentLength)):
-    RemoveThisCol = True
-    FirstBaseSeen = None
-    for base in SeqAlignment[:, column]:
-      if FirstBaseSeen == None:
-        FirstBaseSeen = base
-      elif base != FirstBaseSeen:
-        RemoveThisCol = False
-        break
-    if RemoveThisCol:
-      SeqAlignment = SeqAlignment[:, :column] + SeqAlignment[:, column + 1:]
-      if FirstBaseSeen == '-':
-        NumPureGapCols += 1
+  SeqMatrix = AlignmentAsMatrix(SeqAlignment)
+  InvariantCols = (SeqMatrix == SeqMatrix[0]).all(axis=0)
+  NumPureGapCols = np.count_nonzero(InvariantCols &
+  (SeqMatrix[0] == ord(GapChar)))
+  SeqMatrix = SeqMatrix[:, ~InvariantCols]
   NumColsWithABase = AlignmentLength - NumPureGapCols
-  NumInformativeSites = SeqAlignment.get_alignment_length()
+  NumInformativeSites = SeqMatrix.shape[1]
 
   # Recombination requires sequences at least 2bp long
-  ReducedAlignmentLength = SeqAlignment.get_alignment_length()
+  ReducedAlignmentLength = SeqMatrix.shape[1]
   if ReducedAlignmentLength < 2:
     return MaxScoreAndSeqs
 
-  # Convert all the seqs to strings
-  SeqsAsStrings = [str(seq.seq) for seq in SeqAlignment]
+  IsGap = SeqMatrix == ord(GapChar)
 
   # Calculate the score for sequences i and j being the two original seqs, and
-  # k the recombinant between them.
+  # k the recombinant between them. All k are considered at once.
   for i in range(NumSeqs):
+
+    # Which seqs agree with seq i, at each position
+    AgreesWithI = SeqMatrix == SeqMatrix[i]
+
     for j in range(i+1, NumSeqs):
-      iSeq = SeqsAsStrings[i]
-      jSeq = SeqsAsStrings[j]
-      DisagreeingPositions = []
-      for pos in range(ReducedAlignmentLength):
-        if iSeq[pos] != jSeq[pos] and (IncludeGaps or
-        (iSeq[pos] != '-' and jSeq[pos] != '-')):
-          DisagreeingPositions.append(pos)
+      disagreements = ~AgreesWithI[j]
+      if not IncludeGaps:
+        disagreements &= ~(IsGap[i] | IsGap[j])
+      DisagreeingPositions = np.flatnonzero(disagreements)
 
+      # With fewer than two disagreeing positions, there are no break points.
       NumDisagreeingPositions = len(DisagreeingPositions)
-      if NumDisagreeingPositions == 0:
+      if NumDisagreeingPositions < 2:
         continue
-      for k in range(NumSeqs):
-        if k == i or k == j:
-          continue
-        kSeq = SeqsAsStrings[k]
-
-        # At each position where i and j disagree, record the 'loyalty' value 1
-        # if k agrees with i, -1 if k agrees with j, and 0 otherwise.
-        loyalties = []
-        for pos in DisagreeingPositions:
-          if kSeq[pos] == iSeq[pos]:
-            loyalties.append(1)
-          elif kSeq[pos] == jSeq[pos]:
-            loyalties.append(-1)
-          else:
-            loyalties.append(0)
-
-        # We consider all possible 'break points' for the list of loyalties,
-        # i.e. points at which we split it into a left part and a right part.
-        # The sum of the loyalties to the left or to the right equals (the
-        # Hamming distance of i to k) minus (the Hamming distance of i to j) for
-        # that part of the sequence (i.e. for the left or for the right).
-        # We choose the break point that maximises the difference (between left
-        # and right) of these two Hamming distance differences, i.e. the
-        # difference between the sum of the loyalties to the left and the sum of
-        # the loyalties to the right. For this break point we record the smaller
-        # absolute value of the two loyalty sums.
-        MaxLoyalty = 0
-        MaxLoyaltyDiff = 0
-        LoyaltyLeftOfBreakPoint = 0
-        LoyaltyRightOfBreakPoint = sum(loyalties)
-        for BreakPointPos in range(1, NumDisagreeingPositions):
-          LoyaltyLeftOfBreakPoint  += loyalties[BreakPointPos - 1]
-          LoyaltyRightOfBreakPoint -= loyalties[BreakPointPos - 1]
-          #MeanLoyaltyLeft  = LoyaltyLeftOfBreakPoint / BreakPointPos
-          #MeanLoyaltyRight = LoyaltyRightOfBreakPoint / \
-          #(NumDisagreeingPositions - BreakPointPos)
-          #LoyaltyDiff = abs(MeanLoyaltyLeft - MeanLoyaltyRight)
-          LoyaltyDiff = abs(LoyaltyLeftOfBreakPoint - LoyaltyRightOfBreakPoint)
-          if LoyaltyDiff > MaxLoyaltyDiff:
-            MaxLoyaltyDiff = LoyaltyDiff
-            MaxLoyalty = min(abs(LoyaltyLeftOfBreakPoint),
-            abs(LoyaltyRightOfBreakPoint))
-        if MaxLoyalty > MaxScoreAndSeqs[0]:
-          MaxScoreAndSeqs = (MaxLoyalty, i, j, k)
+
+      # At each position where i and j disagree, record the 'loyalty' value 1
+      # if k agrees with i, -1 if k agrees with j, and 0 otherwise. (k cannot
+      # agree with both.) One row per k.
+      loyalties = AgreesWithI[:, DisagreeingPositions].astype(np.int32) - \
+      (SeqMatrix[:, DisagreeingPositions] ==
+      SeqMatrix[j, DisagreeingPositions])
+
+      # We consider all possible 'break points' for the list of loyalties,
+      # i.e. points at which we split it into a left part and a right part.
+      # The sum of the loyalties to the left or to the right equals (the
+      # Hamming distance of i to k) minus (the Hamming distance of i to j) for
+      # that part of the sequence (i.e. for the left or for the right).
+      # We choose the break point that maximises the difference (between left
+      # and right) of these two Hamming distance differences, i.e. the
+      # difference between the sum of the loyalties to the left and the sum of
+      # the loyalties to the right; the first such break point, if there is a
+      # tie. For this break point we record the smaller absolute value of the
+      # two loyalty sums (or zero, if the difference is zero for every break
+      # point).
+      LoyaltyLeftOfBreakPoint = np.cumsum(loyalties[:, :-1], axis=1)
+      LoyaltyRightOfBreakPoint = \
+      loyalties.sum(axis=1)[:, np.newaxis] - LoyaltyLeftOfBreakPoint
+      LoyaltyDiffs = np.abs(LoyaltyLeftOfBreakPoint - LoyaltyRightOfBreakPoint)
+      BestBreakPoints = LoyaltyDiffs.argmax(axis=1)
+      AllKs = np.arange(NumSeqs)
+      MaxLoyalties = np.minimum(
+      np.abs(LoyaltyLeftOfBreakPoint[AllKs, BestBreakPoints]),
+      np.abs(LoyaltyRightOfBreakPoint[AllKs, BestBreakPoints]))
+      MaxLoyalties[LoyaltyDiffs[AllKs, BestBreakPoints] == 0] = 0
+      MaxLoyalties[[i, j]] = 0
+
+      # The first k with the highest score for this i and j.
+      k = MaxLoyalties.argmax()
+      if MaxLoyalties[k] > MaxScoreAndSeqs[0]:
+        MaxScoreAndSeqs = (int(MaxLoyalties[k]), i, j, int(k))
 
   MaxScore = MaxScoreAndSeqs[0]
   if MaxScore == 0:
@@ -1006,6 +1506,77 @@ def MakeBamIndices(BamFiles, SamtoolsCommand):
         'in the code. Continuing...', file=sys.stderr)
 
 
+def SegmentBounds(length, NumSegments):
+  '''Returns the start and end of each of NumSegments consecutive segments of
+  (as nearly as possible) equal size, covering a string of the given length.'''
+  return [(segment * length / NumSegments, (segment+1) * length / NumSegments) \
+  for segment in range(NumSegments)]
+
+class SimilarStringIndex(object):
+  '''An index of strings, for quickly finding those that could be similar to a
+  given string.
+
+  The number of differences between two strings is taken to be the difference
+  in their lengths plus the number of differing characters over the length of
+  the shorter one, as in MergeSimilarStringsA. If this is no more than the
+  similarity threshold T for two strings whose lengths differ by d, then
+  dividing the first (shorter length) characters into T - d + 1 segments, by the
+  pigeonhole principle the strings must be identical on at least one segment.
+  So for each length of string in the index, and each such segmentation we need
+  for comparing with strings of another length, we index the strings by their
+  segments. Strings sharing no segment with a given string are never compared
+  with it.'''
+
+  def __init__(self, strings, SimilarityThreshold):
+    self.strings = strings
+    self.SimilarityThreshold = SimilarityThreshold
+    self.IndicesByLength = {}
+    for index, string in enumerate(strings):
+      self.IndicesByLength.setdefault(len(string), []).append(index)
+    self.SegmentIndices = {}
+
+  def GetSegmentIndex(self, length, PrefixLength, NumSegments):
+    '''Returns a dict mapping each (segment number, segment) to the indices of
+    those strings of the given length having that segment, for the given
+    segmentation. Each segmentation is made only when first needed.'''
+    key = (length, PrefixLength, NumSegments)
+    if not key in self.SegmentIndices:
+      bounds = SegmentBounds(PrefixLength, NumSegments)
+      SegmentIndex = {}
+      for index in self.IndicesByLength[length]:
+        string = self.strings[index]
+        for SegmentNumber, (start, end) in enumerate(bounds):
+          SegmentIndex.setdefault((SegmentNumber, string[start:end]),
+          []).append(index)
+      self.SegmentIndices[key] = SegmentIndex
+    return self.SegmentIndices[key]
+
+  def FindCandidates(self, string):
+    '''Returns the set of indices of strings that could be within the similarity
+    threshold of the given string. (They still need to be compared with it.)'''
+    candidates = set([])
+    length = len(string)
+    for OtherLength, indices in self.IndicesByLength.items():
+      LengthDiff = abs(OtherLength - length)
+      if LengthDiff > self.SimilarityThreshold:
+        continue
+      PrefixLength = min(length, OtherLength)
+      NumSegments = self.SimilarityThreshold - LengthDiff + 1
+
+      # If there are more segments than characters, some are empty and always
+      # identical.
+      if PrefixLength < NumSegments:
+        candidates.update(indices)
+        continue
+
+      SegmentIndex = self.GetSegmentIndex(OtherLength, PrefixLength,
+      NumSegments)
+      for SegmentNumber, (start, end) in \
+      enumerate(SegmentBounds(PrefixLength, NumSegments)):
+        candidates.update(SegmentIndex.get((SegmentNumber, string[start:end]),
+        []))
+    return candidates
+
 def MergeSimilarStringsA(DictOfStringCounts, SimilarityThreshold=1,
 RecordCorrespondence=False):
   '''Absorbs those strings with lower counts into those with higher counts.
@@ -1044,6 +1615,13 @@ RecordCorrespondence=False):
 
   # Sort the strings by their counts
   SortedDict = sorted(DictOfStringCounts.items(), key=lambda x: x[1])
+  SortedCounts = [count for string, count in SortedDict]
+
+  # Index the strings so as to compare each string only with those that could
+  # be similar to it.
+  SortedStrings = [string for string, count in SortedDict]
+  index = SimilarStringIndex(SortedStrings, SimilarityThreshold)
+  matrix, lengths = StringsAsMatrix(SortedStrings)
 
   PositionsOfStringsThatGetAbsorbed = set([])
   MergedDict = {}
@@ -1056,33 +1634,25 @@ RecordCorrespondence=False):
     CommonString, CommonCount = SortedDict[i]
     CountForJsToMergeToThisI = 0
 
-    for j in range(0, i):
-
-      if j in PositionsOfStringsThatGetAbsorbed:
-        continue
-
+    # Only strings with lower counts than this one, i.e. those before the first
+    # with the same count, can be absorbed into it. Candidates are considered
+    # rarest first.
+    NumRarerStrings = bisect.bisect_left(SortedCounts, CommonCount)
+    candidates = np.array([j for j in sorted(index.FindCandidates(CommonString))
+    if j < NumRarerStrings and not j in PositionsOfStringsThatGetAbsorbed],
+    dtype=np.int64)
+
+    # Compare the candidate strings with this one all at once, and absorb those
+    # within the threshold.
+    WithinThreshold = StringsWithinThreshold(CommonString, matrix, lengths,
+    candidates, SimilarityThreshold)
+    for j in candidates[WithinThreshold]:
       RareString, RareCount = SortedDict[j]
-      if RareCount == CommonCount:
-        break
-
-      # Compare the two strings. Initialise the number of differences as the
-      # difference in string length, then do a pairwise comparison of characters
-      # over the length of the shorter string. As soon as the number of 
-      # differences exceeds the threshold, we know we shouldn't be merging them. 
-      NumDifferingBases = abs(len(RareString) - len(CommonString))
-      if NumDifferingBases > SimilarityThreshold:
-        continue
-      for base1, base2 in itertools.izip(RareString, CommonString):
-        if base1 != base2:
-          NumDifferingBases += 1
-          if NumDifferingBases > SimilarityThreshold:
-            break
-      if NumDifferingBases <= SimilarityThreshold:
-        CountForJsToMergeToThisI += RareCount
-        PositionsOfStringsThatGetAbsorbed.add(j)
-        if RecordCorrespondence:
-          AfterToBeforeDict[CommonString].append(RareString)
-          del AfterToBeforeDict[RareString]
+      CountForJsToMergeToThisI += RareCount
+      PositionsOfStringsThatGetAbsorbed.add(j)
+      if RecordCorrespondence:
+        AfterToBeforeDict[CommonString].append(RareString)
+        del AfterToBeforeDict[RareString]
 
     MergedDict[CommonString] = CommonCount + CountForJsToMergeToThisI
 